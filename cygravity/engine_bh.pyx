@@ -5,6 +5,9 @@ Check README of this repo for links on how Barnes-Hut works in detail.
 '''
 
 import cython
+import heapq
+import random
+import time
 
 
 @cython.freelist(100000)
@@ -110,6 +113,30 @@ cdef class Node():
         result = match_x and match_y
         return result
 
+    def min_distance(self, point):
+        return self._min_distance(point)
+
+    cdef double _min_distance(self, (double, double) point):
+        '''
+        Distance from point to the closest point of the node, 0 if inside
+        '''
+        cdef double delta_x, delta_y
+        delta_x = max(self.pos[0] - point[0], 0, point[0] - self.pos[0] - self.size)
+        delta_y = max(self.pos[1] - point[1], 0, point[1] - self.pos[1] - self.size)
+        return (delta_x ** 2 + delta_y ** 2) ** 0.5
+
+    def max_distance(self, point):
+        return self._max_distance(point)
+
+    cdef double _max_distance(self, (double, double) point):
+        '''
+        Distance from point to the farthest corner of the node
+        '''
+        cdef double delta_x, delta_y
+        delta_x = max(abs(point[0] - self.pos[0]), abs(point[0] - self.pos[0] - self.size))
+        delta_y = max(abs(point[1] - self.pos[1]), abs(point[1] - self.pos[1] - self.size))
+        return (delta_x ** 2 + delta_y ** 2) ** 0.5
+
 
 @cython.cdivision(True)
 cdef class Engine():
@@ -120,23 +147,59 @@ cdef class Engine():
     with the algorithm's accuracy, while values close to 0 will by more
     expensive but return more accurate results.
 
+    If force_error is set, phi is tuned every tune_interval ticks to the
+    largest value keeping the relative force error of tune_samples random
+    bodies below force_error, see tune_phi.
+
+    If diagnostics_interval is set, calc_diagnostics stores energy and
+    momentum in diagnostics every diagnostics_interval ticks.
+
     root_node       -- Node, root node object, new bodies are added here
     phi             -- double, the engines accuracy (default 0.5)
     size            -- double, the engines space size
     collision_mode  -- string, the current collision_mode (default 'elastic')
     collision_modes -- dict, mapping modes against collsion methods
+    force_error     -- double or None, relative force error budget (default None)
+    tune_interval   -- int, tune phi every n ticks (default 10)
+    tune_samples    -- int, bodies sampled per tuning (default 32)
+    ticks           -- int, number of ticks done
+    tree_built      -- int flag, tree in root_node matches body positions
+                       as of the last query, see invalidate_tree
+    diagnostics_interval -- int, calculate diagnostics every n ticks (default 0, off)
+    diagnostics     -- dict or None, result of last calc_diagnostics
     '''
     cdef public Node root_node
     cdef public double phi
     cdef public double size
     cdef public str collision_mode
     cdef public dict collision_modes
-
-
-    def __init__(self, size, phi=0.5, collision_mode='elastic'):
+    cdef public object force_error
+    cdef public int tune_interval
+    cdef public int tune_samples
+    cdef public int ticks
+    cdef public int tree_built
+    cdef public int diagnostics_interval
+    cdef public object diagnostics
+    cdef object random
+
+
+    def __init__(self, size, phi=0.5, collision_mode='elastic',
+                 force_error=None, tune_interval=10, tune_samples=32,
+                 diagnostics_interval=None):
         self.root_node = Node((0, 0), size)
         self.phi = phi  # 10
         self.size = size
+        self.ticks = 0
+        self.tree_built = False
+
+        self.force_error = force_error
+        assert tune_interval >= 1, 'Invalid tune_interval!'
+        self.tune_interval = tune_interval
+        self.tune_samples = tune_samples
+        self.random = random.Random(0)
+
+        self.diagnostics_interval = diagnostics_interval or 0
+        self.diagnostics = None
 
         self.collision_modes = {
             'elastic': self.elastic_collision,
@@ -277,6 +340,159 @@ cdef class Engine():
         force_y = force * delta_y / dist
         return force_x, force_y
 
+    cdef (double, double) sample_force(self, Body body1, Body body2):
+        '''
+        Force between two bodies without side effects, colliding bodies do
+        not attract each other
+        '''
+        cdef double dist, delta_x, delta_y, force
+        dist, delta_x, delta_y = self.calc_distance(body1.cog, body2.cog)
+        if dist <= 2:
+            return 0, 0
+        force = (body1.mass * body2.mass) / (dist ** 2)
+        return force * delta_x / dist, force * delta_y / dist
+
+    cdef (double, double) tree_force(self, Body body, Node node, double phi):
+        '''
+        Force on body using the tree with accuracy phi, same decisions as
+        _force_traverse but without collisions
+        '''
+        cdef double dist, delta_x, delta_y, force, force_x, force_y, child_x, child_y
+        cdef Body second_body
+        cdef Node child
+        if len(node.bodies) == 1:
+            second_body = node.bodies[0]
+            if body is second_body:
+                return 0, 0
+            return self.sample_force(body, second_body)
+        dist, delta_x, delta_y = self.calc_distance(body.cog, node.cog)
+        if not dist:
+            dist = .5
+        if node.size / dist < phi:
+            force = (body.mass * node.mass) / (dist ** 2)
+            return force * delta_x / dist, force * delta_y / dist
+        force_x = 0
+        force_y = 0
+        for child in node.children:
+            child_x, child_y = self.tree_force(body, child, phi)
+            force_x += child_x
+            force_y += child_y
+        return force_x, force_y
+
+    cdef (double, double) exact_force(self, Body body):
+        cdef double force_x, force_y, other_x, other_y
+        cdef Body other
+        force_x = 0
+        force_y = 0
+        for other in self.root_node.bodies:
+            if other is not body:
+                other_x, other_y = self.sample_force(body, other)
+                force_x += other_x
+                force_y += other_y
+        return force_x, force_y
+
+    cdef double force_error_for(self, list samples, list exact, double phi):
+        '''
+        Relative force error of the tree for given phi: norm of all force
+        errors divided by norm of all exact forces of the sampled bodies
+        '''
+        cdef double error, total, force_x, force_y, exact_x, exact_y
+        cdef Body body
+        cdef int i
+        error = 0
+        total = 0
+        for i in range(len(samples)):
+            body = samples[i]
+            exact_x, exact_y = exact[i]
+            force_x, force_y = self.tree_force(body, self.root_node, phi)
+            error += (force_x - exact_x) ** 2 + (force_y - exact_y) ** 2
+            total += exact_x ** 2 + exact_y ** 2
+        if not total:
+            return 0
+        return (error / total) ** 0.5
+
+    def tune_phi(self, int steps=8, double phi_max=2.0):
+        '''
+        Set phi to the largest value (bisecting between 0 and phi_max) which
+        keeps the relative force error of some random bodies below half of
+        force_error. Few samples tend to miss the bodies with the largest
+        errors, the margin keeps the error of all bodies within budget.
+        Needs a built tree.
+        '''
+        cdef list bodies, samples, exact
+        cdef double low, high, phi, budget
+        cdef Body body
+        budget = self.force_error / 2
+        bodies = self.root_node.bodies
+        samples = self.random.sample(bodies, min(self.tune_samples, len(bodies)))
+        exact = [self.exact_force(body) for body in samples]
+        if self.force_error_for(samples, exact, phi_max) <= budget:
+            self.phi = phi_max
+            return
+        low = 0
+        high = phi_max
+        for _ in range(steps):
+            phi = (low + high) / 2
+            if self.force_error_for(samples, exact, phi) <= budget:
+                low = phi
+            else:
+                high = phi
+        self.phi = low
+
+    cdef double tree_potential(self, Body body, Node node):
+        '''
+        Potential energy of body against all other bodies using the tree with
+        the same phi criterion as _force_traverse
+        '''
+        cdef double dist, potential
+        cdef Body other
+        cdef Node child
+        if len(node.bodies) == 1:
+            other = node.bodies[0]
+            dist = self.calc_distance(body.cog, other.cog)[0]
+            if other is body or not dist:
+                return 0
+            return -body.mass * other.mass / dist
+        dist = self.calc_distance(body.cog, node.cog)[0]
+        if dist and node.size / dist < self.phi:
+            return -body.mass * node.mass / dist
+        potential = 0
+        for child in node.children:
+            potential += self.tree_potential(body, child)
+        return potential
+
+    def calc_diagnostics(self):
+        '''
+        Total energy, momentum and angular momentum (around origin) of all
+        bodies. Potential energy is approximated using the tree, the time
+        taken is reported separately from ticks.
+        '''
+        cdef double start, kinetic, potential, momentum_x, momentum_y, angular_momentum
+        cdef Body body
+        start = time.perf_counter()
+        self.build_tree()
+        kinetic = 0
+        potential = 0
+        momentum_x = 0
+        momentum_y = 0
+        angular_momentum = 0
+        for body in self.root_node.bodies:
+            kinetic += body.mass * (body.vel[0] ** 2 + body.vel[1] ** 2) / 2
+            momentum_x += body.mass * body.vel[0]
+            momentum_y += body.mass * body.vel[1]
+            angular_momentum += body.mass * (body.cog[0] * body.vel[1] - body.cog[1] * body.vel[0])
+            potential += self.tree_potential(body, self.root_node)
+        # each pair is seen from both bodies
+        potential /= 2
+        return {
+            'kinetic': kinetic,
+            'potential': potential,
+            'energy': kinetic + potential,
+            'momentum': (momentum_x, momentum_y),
+            'angular_momentum': angular_momentum,
+            'time': time.perf_counter() - start,
+        }
+
     def force_traverse(self, body, node):
         self._force_traverse(body, node)
 
@@ -342,7 +558,10 @@ cdef class Engine():
         '''
         cdef Body body
         cdef double ax, ay, TIMERATIO
-        self.init_children(self.root_node)
+        # reuses a tree built by queries since the last body change
+        self.build_tree()
+        if self.force_error is not None and self.ticks % self.tune_interval == 0:
+            self.tune_phi()
         for body in self.root_node.bodies:
             body.collision = False
             body.next_force_x = 0
@@ -363,6 +582,26 @@ cdef class Engine():
         self.root_node.bodies = [
             b for b in self.root_node.bodies if not b.remove
         ]
+        self.tree_built = False
+        self.ticks += 1
+        if self.diagnostics_interval and self.ticks % self.diagnostics_interval == 0:
+            self.diagnostics = self.calc_diagnostics()
+
+    def build_tree(self):
+        '''
+        Build the tree for current body positions unless done already.
+        Queries and the next tick share one tree, call invalidate_tree after
+        changing root_node.bodies directly.
+        '''
+        if not self.tree_built:
+            self.init_children(self.root_node)
+            self.tree_built = True
+
+    def invalidate_tree(self):
+        '''
+        Drop the current tree, the next query or tick builds a new one
+        '''
+        self.tree_built = False
 
     cdef void init_children(self, Node node):
         '''
@@ -372,6 +611,7 @@ cdef class Engine():
         '''
         node._calc_cog()
         if len(node.bodies) <= 1:
+            node.children = []
             return
         node.children = self.slice_node(node)
         for child in node.children:
@@ -382,6 +622,7 @@ cdef class Engine():
         Method to be called from extern to add more bodies to the simulation
         '''
         self.root_node.bodies.append(Body(cog, vel, mass, fixed))
+        self.tree_built = False
 
     def print_children(self, node):
         '''
@@ -399,3 +640,100 @@ cdef class Engine():
         yield node
         for child in node.children:
             yield from self.traverse_node(child)
+
+    def iter_nodes(self, node=None, max_depth=None):
+        '''
+        Iterate over node (default root_node) and all nodes below in the same
+        order as traverse_node, but without recursion. Nodes deeper than
+        max_depth levels below node are skipped, e.g. for level of detail.
+        '''
+        self.build_tree()
+        stack = [(node if node is not None else self.root_node, 0)]
+        while stack:
+            node, depth = stack.pop()
+            yield node
+            if max_depth is None or depth < max_depth:
+                stack.extend((child, depth + 1) for child in reversed(node.children))
+
+    def query_rect(self, pos, double width, double height):
+        '''
+        Bodies with pos[0] <= x < pos[0] + width and pos[1] <= y < pos[1] + height
+        '''
+        cdef double x0, y0, x1, y1
+        cdef list result, stack
+        cdef Node node
+        cdef Body body
+        self.build_tree()
+        x0, y0 = pos
+        x1 = x0 + width
+        y1 = y0 + height
+        result = []
+        stack = [self.root_node]
+        while stack:
+            node = stack.pop()
+            if (node.pos[0] >= x1 or node.pos[0] + node.size <= x0 or
+                    node.pos[1] >= y1 or node.pos[1] + node.size <= y0):
+                continue
+            if not node.children:
+                for body in node.bodies:
+                    if x0 <= body.cog[0] < x1 and y0 <= body.cog[1] < y1:
+                        result.append(body)
+            elif (node.pos[0] >= x0 and node.pos[0] + node.size <= x1 and
+                    node.pos[1] >= y0 and node.pos[1] + node.size <= y1):
+                result.extend(node.bodies)
+            else:
+                stack.extend(node.children)
+        return result
+
+    def query_radius(self, point, double radius):
+        '''
+        Bodies with a distance of at most radius to point
+        '''
+        cdef list result, stack
+        cdef Node node
+        cdef Body body
+        self.build_tree()
+        result = []
+        stack = [self.root_node]
+        while stack:
+            node = stack.pop()
+            if node._min_distance(point) > radius:
+                continue
+            if not node.children:
+                for body in node.bodies:
+                    if self.calc_distance(body.cog, point)[0] <= radius:
+                        result.append(body)
+            elif node._max_distance(point) <= radius:
+                result.extend(node.bodies)
+            else:
+                stack.extend(node.children)
+        return result
+
+    def query_nearest(self, point, int k=1):
+        '''
+        The k bodies closest to point, closest first
+        '''
+        cdef list result, heap
+        cdef Node node, child
+        cdef Body body
+        cdef int counter
+        self.build_tree()
+        result = []
+        # (distance, tie breaker, is_body, node or body)
+        heap = [(self.root_node._min_distance(point), 0, False, self.root_node)]
+        counter = 1
+        while heap and len(result) < k:
+            _, _, is_body, item = heapq.heappop(heap)
+            if is_body:
+                result.append(item)
+                continue
+            node = item
+            if not node.children:
+                for body in node.bodies:
+                    heapq.heappush(heap, (self.calc_distance(body.cog, point)[0], counter, True, body))
+                    counter += 1
+            else:
+                for child in node.children:
+                    heapq.heappush(heap, (child._min_distance(point), counter, False, child))
+                    counter += 1
+        return result
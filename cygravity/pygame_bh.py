@@ -1,8 +1,14 @@
 import pygame
-from engine_bh import Engine
+from pygravity.backends import load
 import random
 import math
 
+Engine = load('cython')
+if Engine is None:
+    raise ImportError(
+        'cygravity extension is not built, run: python setup.py build_ext --inplace'
+    )
+
 FPS = 60
 
 LEFT = 1  # left mouse button
@@ -102,7 +108,7 @@ def main():
             engine.tick()
 
         if draw_boxes:
-            for node in engine.traverse_node(engine.root_node):
+            for node in engine.iter_nodes():
                 node_surface = pygame.Surface(
                     (node.size / SCALE, node.size / SCALE)
                 )
@@ -0,0 +1,424 @@
+'''
+Registry of all engine backends
+
+Knows where each engine lives, what it supports and which of them can be
+imported on this host. select picks the fastest backend for a number of
+bodies and a force error budget using a calibration table, which is measured
+once per host by calibrate and cached as JSON
+(~/.cache/pygravity/calibration.json or PYGRAVITY_CALIBRATION). Backends
+taking phi are calibrated at each of PHIS, so the budget decides which phi
+the chosen backend runs with.
+
+All backends share the add_body(cog, vel, mass[, fixed]) and tick API.
+
+Capabilities per backend:
+
+collision_modes -- tuple, supported collision_mode values
+fixed           -- bool, honours fixed bodies
+diagnostics     -- bool, provides calc_diagnostics and diagnostics_interval
+dimensions      -- int, spatial dimensions simulated
+accuracy        -- string, 'exact', 'tuned' (accepts force_error) or 'fixed'
+                   (error measured during calibration)
+auto            -- bool, considered by select
+
+Besides capabilities, entries list the modules to import the engine from,
+whether the engine takes size (sized) and phi (phi), and options passed to
+the engine by default.
+'''
+
+import importlib
+import json
+import math
+import os
+import platform
+import random
+import time
+import warnings
+
+
+# force error budget of select if none is given, about what the default
+# phi of 0.5 gives
+DEFAULT_FORCE_ERROR = .02
+
+# collision mode of select if none is given, backends without collisions are
+# only picked when collision_mode=None is passed explicitly
+DEFAULT_COLLISION_MODE = 'elastic'
+
+# phi values backends taking phi are calibrated at
+PHIS = (.25, .5, 1.0)
+
+# calibration bodies are this light, so they hardly move during the measured
+# tick and bodies moved early do not change the forces on later ones
+CALIBRATION_MASS = 1e-4
+
+BACKENDS = {
+    'rk4': {
+        'modules': ('pygravity.engine_rk4',),
+        'sized': False,
+        'phi': False,
+        'capabilities': {
+            'collision_modes': ('inelastic',),
+            'fixed': False,
+            'diagnostics': False,
+            'dimensions': 2,
+            'accuracy': 'exact',
+            'auto': True,
+        },
+    },
+    'bh': {
+        'modules': ('pygravity.engine_bh',),
+        'sized': True,
+        'phi': True,
+        'capabilities': {
+            'collision_modes': ('elastic', 'inelastic'),
+            'fixed': False,
+            'diagnostics': True,
+            'dimensions': 2,
+            'accuracy': 'tuned',
+            'auto': True,
+        },
+    },
+    'cython': {
+        # built in place the extension ends up as top level module
+        'modules': ('cygravity.engine_bh', 'engine_bh'),
+        'sized': True,
+        'phi': True,
+        'capabilities': {
+            'collision_modes': ('elastic', 'inelastic'),
+            'fixed': True,
+            'diagnostics': True,
+            'dimensions': 2,
+            'accuracy': 'tuned',
+            'auto': True,
+        },
+    },
+    'numba': {
+        'modules': ('pygravity.engine_numba',),
+        'sized': True,
+        'phi': True,
+        'capabilities': {
+            'collision_modes': ('elastic', 'inelastic'),
+            'fixed': True,
+            'diagnostics': True,
+            'dimensions': 2,
+            'accuracy': 'fixed',
+            'auto': True,
+        },
+    },
+    'pm': {
+        'modules': ('pygravity.engine_pm',),
+        'sized': True,
+        'phi': False,
+        # the mesh alone can not resolve close pairs
+        'options': {'short_range': True},
+        'capabilities': {
+            'collision_modes': (),
+            'fixed': True,
+            'diagnostics': True,
+            'dimensions': 2,
+            'accuracy': 'fixed',
+            'auto': True,
+        },
+    },
+    'distributed': {
+        'modules': ('pygravity.engine_distributed',),
+        'sized': True,
+        'phi': True,
+        'capabilities': {
+            'collision_modes': ('elastic', 'inelastic'),
+            'fixed': False,
+            'diagnostics': False,
+            'dimensions': 2,
+            'accuracy': 'fixed',
+            # trades speed for memory of many hosts, only used on request
+            'auto': False,
+        },
+    },
+}
+
+_engines = {}
+
+
+def load(name):
+    '''
+    Engine class of backend name, None if it can not be imported
+    '''
+    assert name in BACKENDS, 'Invalid backend!'
+    if name not in _engines:
+        _engines[name] = None
+        for module in BACKENDS[name]['modules']:
+            try:
+                _engines[name] = importlib.import_module(module).Engine
+                break
+            except ImportError:
+                continue
+    return _engines[name]
+
+
+def available():
+    '''
+    Names of all backends importable on this host
+    '''
+    return [name for name in BACKENDS if load(name) is not None]
+
+
+def capabilities(name):
+    assert name in BACKENDS, 'Invalid backend!'
+    return dict(BACKENDS[name]['capabilities'])
+
+
+def create(size, backend=None, bodies=None, force_error=None, **kwargs):
+    '''
+    Create an engine, backend defaults to choose(bodies, force_error,
+    collision_mode) and phi to the calibrated phi meeting force_error. Pass
+    collision_mode=None to allow backends without collisions. Other keyword
+    arguments are passed to the engine.
+    '''
+    collision_mode = kwargs.get('collision_mode', DEFAULT_COLLISION_MODE)
+    if collision_mode is None:
+        del kwargs['collision_mode']
+    if backend is None:
+        backend, phi = choose(bodies or 0, force_error=force_error,
+                              collision_mode=collision_mode,
+                              diagnostics=bool(kwargs.get('diagnostics_interval')))
+        if phi is not None:
+            kwargs.setdefault('phi', phi)
+    engine_cls = load(backend)
+    assert engine_cls is not None, 'Backend %s not available!' % backend
+    for key, value in BACKENDS[backend].get('options', {}).items():
+        kwargs.setdefault(key, value)
+    if force_error is not None and BACKENDS[backend]['capabilities']['accuracy'] == 'tuned':
+        kwargs['force_error'] = force_error
+    if BACKENDS[backend]['sized']:
+        return engine_cls(size, **kwargs)
+    return engine_cls(**kwargs)
+
+
+def positions(engine):
+    '''
+    Body positions of engine in order of add_body calls
+    '''
+    if hasattr(engine, 'planets'):
+        return [(p.state.pos_x, p.state.pos_y) for p in engine.planets.values()]
+    return [body.cog for body in engine.root_node.bodies]
+
+
+def calibration_path():
+    return os.environ.get('PYGRAVITY_CALIBRATION', os.path.join(
+        os.path.expanduser('~'), '.cache', 'pygravity', 'calibration.json'
+    ))
+
+
+def load_calibration():
+    '''
+    Cached calibration table of this host, empty if there is none
+    '''
+    try:
+        with open(calibration_path()) as calibration_file:
+            table = json.load(calibration_file)
+    except (OSError, ValueError):
+        return {}
+    if table.get('host') != platform.node():
+        return {}
+    return table['backends']
+
+
+def save_calibration(table):
+    path = calibration_path()
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+    with open(path, 'w') as calibration_file:
+        json.dump({'host': platform.node(), 'backends': table}, calibration_file, indent=2)
+
+
+def random_layout(bodies, spacing=10, min_dist=4, seed=0):
+    '''
+    Bodies placed uniformly at random, one per spacing ** 2 on average. Close
+    neighbours are kept, as they dominate the error of mesh based backends,
+    but no pair is closer than min_dist, so nothing collides. Returns the
+    cogs and a space size holding all of them.
+    '''
+    rng = random.Random(seed)
+    side = math.sqrt(bodies) * spacing
+    cells = {}
+    cogs = []
+    while len(cogs) < bodies:
+        cog = (rng.uniform(0, side), rng.uniform(0, side))
+        cell_x = int(cog[0] // min_dist)
+        cell_y = int(cog[1] // min_dist)
+        if any(
+            math.dist(cog, other) < min_dist
+            for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+            for other in cells.get((cell_x + dx, cell_y + dy), ())
+        ):
+            continue
+        cells.setdefault((cell_x, cell_y), []).append(cog)
+        cogs.append(cog)
+    return cogs, side + spacing
+
+
+def measure_error(cogs, before, after, samples=32):
+    '''
+    Relative error of the displacement of some bodies against the exact
+    acceleration. Displacement and acceleration are compared up to a common
+    factor, so the timestep and integrator of a backend do not matter.
+    '''
+    step = max(len(cogs) // samples, 1)
+    picked = range(0, len(cogs), step)
+    exact = []
+    for i in picked:
+        acc_x = acc_y = 0
+        for j, other in enumerate(cogs):
+            if i != j:
+                dist = math.dist(cogs[i], other)
+                acc_x -= (cogs[i][0] - other[0]) / dist ** 3
+                acc_y -= (cogs[i][1] - other[1]) / dist ** 3
+        exact.append((acc_x, acc_y))
+    moved = [(after[i][0] - before[i][0], after[i][1] - before[i][1]) for i in picked]
+
+    norm = sum(acc_x ** 2 + acc_y ** 2 for acc_x, acc_y in exact)
+    if not norm:
+        return 0
+    factor = sum(m[0] * e[0] + m[1] * e[1] for m, e in zip(moved, exact)) / norm
+    if not factor:
+        return 1
+    error = sum(
+        (m[0] - factor * e[0]) ** 2 + (m[1] - factor * e[1]) ** 2
+        for m, e in zip(moved, exact)
+    )
+    return math.sqrt(error / norm) / abs(factor)
+
+
+def calibrate(names=None, sizes=(256, 1024, 4096, 16384, 65536), max_seconds=2.0,
+              repeat=3, save=True):
+    '''
+    Measure seconds per tick of backends (default all available ones with
+    auto set) for growing numbers of bodies, until a tick takes longer than
+    max_seconds. Each size is timed over up to repeat ticks and the fastest
+    one is kept. Backends taking phi get one run per value of PHIS. Each run
+    stores the force error of the first tick at its largest size as well.
+    '''
+    if names is None:
+        names = [name for name in available() if BACKENDS[name]['capabilities']['auto']]
+    table = load_calibration()
+    for name in names:
+        # first tick may include compilation (numba)
+        warmup, size = random_layout(16)
+        engine = create(size, backend=name)
+        for cog in warmup:
+            engine.add_body(cog=cog, vel=(0, 0), mass=CALIBRATION_MASS)
+        engine.tick()
+
+        runs = []
+        for phi in PHIS if BACKENDS[name]['phi'] else (None,):
+            options = {} if phi is None else {'phi': phi}
+            ticks = []
+            error = None
+            for bodies in sizes:
+                cogs, size = random_layout(bodies)
+                engine = create(size, backend=name, **options)
+                for cog in cogs:
+                    engine.add_body(cog=cog, vel=(0, 0), mass=CALIBRATION_MASS)
+                before = positions(engine)
+                seconds = None
+                for i in range(repeat):
+                    start = time.perf_counter()
+                    engine.tick()
+                    elapsed = time.perf_counter() - start
+                    if i == 0:
+                        error = measure_error(cogs, before, positions(engine))
+                    seconds = elapsed if seconds is None else min(seconds, elapsed)
+                    # slow ticks are not noisy enough to be worth repeating
+                    if elapsed > max_seconds:
+                        break
+                ticks.append((bodies, seconds))
+                if seconds > max_seconds:
+                    break
+            runs.append({'phi': phi, 'ticks': ticks, 'force_error': error})
+        table[name] = {'runs': runs}
+    if save:
+        save_calibration(table)
+    return table
+
+
+def estimate(ticks, bodies):
+    '''
+    Seconds per tick for bodies, interpolated (or extrapolated) on a log-log
+    scale between the closest measured sizes
+    '''
+    if len(ticks) == 1:
+        return ticks[0][1] * bodies / ticks[0][0]
+    for (n1, t1), (n2, t2) in zip(ticks, ticks[1:]):
+        if bodies <= n2:
+            break
+    slope = math.log(t2 / t1) / math.log(n2 / n1)
+    return t1 * (max(bodies, 1) / n1) ** slope
+
+
+def choose(bodies, force_error=None, collision_mode=DEFAULT_COLLISION_MODE,
+           fixed=False, dimensions=2, calibration=None, diagnostics=False):
+    '''
+    Name and phi (None for backends without phi) of the fastest available
+    backend for the number of bodies which supports the requested features
+    and meets force_error (relative force error, default
+    DEFAULT_FORCE_ERROR). collision_mode None allows backends without
+    collisions, diagnostics requires calc_diagnostics. Calibrates missing
+    backends first.
+    '''
+    if force_error is None:
+        force_error = DEFAULT_FORCE_ERROR
+    candidates = []
+    for name in available():
+        caps = BACKENDS[name]['capabilities']
+        if not caps['auto'] or caps['dimensions'] < dimensions:
+            continue
+        if collision_mode is not None and collision_mode not in caps['collision_modes']:
+            continue
+        if fixed and not caps['fixed']:
+            continue
+        if diagnostics and not caps['diagnostics']:
+            continue
+        candidates.append(name)
+    assert candidates, 'No backend matches!'
+
+    if calibration is None:
+        calibration = load_calibration()
+        # tables of older versions lack runs
+        missing = [name for name in candidates if 'runs' not in calibration.get(name, {})]
+        if missing:
+            warnings.warn(
+                'Calibrating backends %s, this takes one to two minutes and is '
+                'cached in %s' % (', '.join(missing), calibration_path()),
+                stacklevel=2,
+            )
+            calibration = calibrate(missing)
+
+    best = None
+    for name in candidates:
+        entry = calibration.get(name)
+        if entry is None:
+            continue
+        runs = [run for run in entry['runs'] if run['force_error'] <= force_error]
+        if not runs and BACKENDS[name]['capabilities']['accuracy'] == 'tuned':
+            # the engine tunes phi below all calibrated ones, measured costs
+            # grow about with the square root of the error reduction
+            run = min(entry['runs'], key=lambda run: run['force_error'])
+            seconds = estimate(run['ticks'], bodies) * math.sqrt(
+                run['force_error'] / force_error
+            )
+            if best is None or seconds < best[0]:
+                best = (seconds, name, run['phi'])
+        for run in runs:
+            seconds = estimate(run['ticks'], bodies)
+            if best is None or seconds < best[0]:
+                best = (seconds, name, run['phi'])
+    assert best is not None, 'No backend meets force_error!'
+    return best[1], best[2]
+
+
+def select(bodies, force_error=None, collision_mode=DEFAULT_COLLISION_MODE,
+           fixed=False, dimensions=2, calibration=None, diagnostics=False):
+    '''
+    Name of the backend choose picks, see choose
+    '''
+    return choose(bodies, force_error, collision_mode, fixed, dimensions,
+                  calibration, diagnostics)[0]
@@ -2,7 +2,10 @@
 Barnes-Hut n-body engine
 '''
 
+import heapq
 import math
+import random
+import time
 
 
 class Body(object):
@@ -38,13 +41,46 @@ class Node(object):
         match_y = body.cog[1] >= self.pos[1] and body.cog[1] < self.pos[1] + self.size
         return match_x and match_y
 
+    def min_distance(self, point):
+        '''
+        Distance from point to the closest point of the node, 0 if inside
+        '''
+        delta_x = max(self.pos[0] - point[0], 0, point[0] - self.pos[0] - self.size)
+        delta_y = max(self.pos[1] - point[1], 0, point[1] - self.pos[1] - self.size)
+        return math.sqrt(delta_x ** 2 + delta_y ** 2)
+
+    def max_distance(self, point):
+        '''
+        Distance from point to the farthest corner of the node
+        '''
+        delta_x = max(abs(point[0] - self.pos[0]), abs(point[0] - self.pos[0] - self.size))
+        delta_y = max(abs(point[1] - self.pos[1]), abs(point[1] - self.pos[1] - self.size))
+        return math.sqrt(delta_x ** 2 + delta_y ** 2)
+
 
 class Engine(object):
 
-    def __init__(self, size, phi=0.5, collision_mode='elastic'):
+    def __init__(self, size, phi=0.5, collision_mode='elastic',
+                 force_error=None, tune_interval=10, tune_samples=32,
+                 diagnostics_interval=None):
         self.root_node = Node((0, 0), size)
         self.phi = phi  # 10
         self.collision_mode = collision_mode
+        self.ticks = 0
+        # tree in root_node matches current body positions
+        self.tree_built = False
+
+        # phi is tuned every tune_interval ticks to meet force_error, the
+        # relative force error measured on tune_samples random bodies
+        self.force_error = force_error
+        assert tune_interval >= 1, 'Invalid tune_interval!'
+        self.tune_interval = tune_interval
+        self.tune_samples = tune_samples
+        self.random = random.Random(0)
+
+        # energy and momentum are calculated every diagnostics_interval ticks
+        self.diagnostics_interval = diagnostics_interval
+        self.diagnostics = None
 
         self.collision_modes = {
             'elastic': self.elastic_collision,
@@ -165,32 +201,183 @@ class Engine(object):
                 for child in node.children:
                     self.force_traverse(body, child)
 
+    def sample_force(self, body1, body2):
+        '''
+        Force between two bodies without side effects, colliding bodies do
+        not attract each other
+        '''
+        dist, delta_x, delta_y = self.calc_distance(body1.cog, body2.cog)
+        if dist <= 2:
+            return 0, 0
+        force = (body1.mass * body2.mass) / (dist ** 2)
+        return force * delta_x / dist, force * delta_y / dist
+
+    def tree_force(self, body, node, phi):
+        '''
+        Force on body using the tree with accuracy phi, same decisions as
+        force_traverse but without collisions
+        '''
+        if len(node.bodies) == 1:
+            if node.bodies[0] is body:
+                return 0, 0
+            return self.sample_force(body, node.bodies[0])
+        dist, delta_x, delta_y = self.calc_distance(body.cog, node.cog)
+        if not dist:
+            dist = .5
+        if node.size / dist < phi:
+            force = (body.mass * node.mass) / (dist ** 2)
+            return force * delta_x / dist, force * delta_y / dist
+        force_x = force_y = 0
+        for child in node.children:
+            child_x, child_y = self.tree_force(body, child, phi)
+            force_x += child_x
+            force_y += child_y
+        return force_x, force_y
+
+    def exact_force(self, body):
+        force_x = force_y = 0
+        for other in self.root_node.bodies:
+            if other is not body:
+                other_x, other_y = self.sample_force(body, other)
+                force_x += other_x
+                force_y += other_y
+        return force_x, force_y
+
+    def force_error_for(self, samples, exact, phi):
+        '''
+        Relative force error of the tree for given phi: norm of all force
+        errors divided by norm of all exact forces of the sampled bodies
+        '''
+        error = total = 0
+        for body, (exact_x, exact_y) in zip(samples, exact):
+            force_x, force_y = self.tree_force(body, self.root_node, phi)
+            error += (force_x - exact_x) ** 2 + (force_y - exact_y) ** 2
+            total += exact_x ** 2 + exact_y ** 2
+        if not total:
+            return 0
+        return math.sqrt(error / total)
+
+    def tune_phi(self, steps=8, phi_max=2.0):
+        '''
+        Set phi to the largest value (bisecting between 0 and phi_max) which
+        keeps the relative force error of some random bodies below half of
+        force_error. Few samples tend to miss the bodies with the largest
+        errors, the margin keeps the error of all bodies within budget.
+        Needs a built tree.
+        '''
+        budget = self.force_error / 2
+        bodies = self.root_node.bodies
+        samples = self.random.sample(bodies, min(self.tune_samples, len(bodies)))
+        exact = [self.exact_force(body) for body in samples]
+        if self.force_error_for(samples, exact, phi_max) <= budget:
+            self.phi = phi_max
+            return
+        low, high = 0, phi_max
+        for _ in range(steps):
+            phi = (low + high) / 2
+            if self.force_error_for(samples, exact, phi) <= budget:
+                low = phi
+            else:
+                high = phi
+        self.phi = low
+
+    def tree_potential(self, body, node):
+        '''
+        Potential energy of body against all other bodies using the tree with
+        the same phi criterion as force_traverse
+        '''
+        if len(node.bodies) == 1:
+            other = node.bodies[0]
+            dist = self.calc_distance(body.cog, other.cog)[0]
+            if other is body or not dist:
+                return 0
+            return -body.mass * other.mass / dist
+        dist = self.calc_distance(body.cog, node.cog)[0]
+        if dist and node.size / dist < self.phi:
+            return -body.mass * node.mass / dist
+        return sum(self.tree_potential(body, child) for child in node.children)
+
+    def calc_diagnostics(self):
+        '''
+        Total energy, momentum and angular momentum (around origin) of all
+        bodies. Potential energy is approximated using the tree, the time
+        taken is reported separately from ticks.
+        '''
+        start = time.perf_counter()
+        self.build_tree()
+        kinetic = momentum_x = momentum_y = angular_momentum = 0
+        for body in self.root_node.bodies:
+            kinetic += body.mass * (body.vel[0] ** 2 + body.vel[1] ** 2) / 2
+            momentum_x += body.mass * body.vel[0]
+            momentum_y += body.mass * body.vel[1]
+            angular_momentum += body.mass * (body.cog[0] * body.vel[1] - body.cog[1] * body.vel[0])
+        # each pair is seen from both bodies
+        potential = sum(
+            self.tree_potential(body, self.root_node)
+            for body in self.root_node.bodies
+        ) / 2
+        return {
+            'kinetic': kinetic,
+            'potential': potential,
+            'energy': kinetic + potential,
+            'momentum': (momentum_x, momentum_y),
+            'angular_momentum': angular_momentum,
+            'time': time.perf_counter() - start,
+        }
+
+    def move_body(self, body):
+        body.collision = False
+        body.next_force_x = 0
+        body.next_force_y = 0
+        self.force_traverse(body, self.root_node)
+        ax = -body.next_force_x / body.mass
+        ay = -body.next_force_y / body.mass
+        TIMERATIO = .1
+        body.vel = (
+            body.vel[0] + ax * TIMERATIO,
+            body.vel[1] + ay * TIMERATIO
+        )
+        body.cog = (
+            body.cog[0] + body.vel[0] * TIMERATIO,
+            body.cog[1] + body.vel[1] * TIMERATIO
+        )
+
     def tick(self):
-        self.init_children(self.root_node)
+        # reuses a tree built by queries since the last body change
+        self.build_tree()
+        if self.force_error is not None and self.ticks % self.tune_interval == 0:
+            self.tune_phi()
         for body in self.root_node.bodies:
-            body.collision = False
-            body.next_force_x = 0
-            body.next_force_y = 0
-            self.force_traverse(body, self.root_node)
-            ax = -body.next_force_x / body.mass
-            ay = -body.next_force_y / body.mass
-            TIMERATIO = .1
-            body.vel = (
-                body.vel[0] + ax * TIMERATIO,
-                body.vel[1] + ay * TIMERATIO
-            )
-            body.cog = (
-                body.cog[0] + body.vel[0] * TIMERATIO,
-                body.cog[1] + body.vel[1] * TIMERATIO
-            )
+            self.move_body(body)
 
         self.root_node.bodies = [
             b for b in self.root_node.bodies if not b.remove
         ]
+        self.tree_built = False
+        self.ticks += 1
+        if self.diagnostics_interval and self.ticks % self.diagnostics_interval == 0:
+            self.diagnostics = self.calc_diagnostics()
+
+    def build_tree(self):
+        '''
+        Build the tree for current body positions unless done already.
+        Queries and the next tick share one tree, call invalidate_tree after
+        changing root_node.bodies directly.
+        '''
+        if not self.tree_built:
+            self.init_children(self.root_node)
+            self.tree_built = True
+
+    def invalidate_tree(self):
+        '''
+        Drop the current tree, the next query or tick builds a new one
+        '''
+        self.tree_built = False
 
     def init_children(self, node):
         node.calc_cog()
         if len(node.bodies) <= 1:
+            node.children = []
             return
         node.children = self.slice_node(node)
         for child in node.children:
@@ -198,6 +385,7 @@ class Engine(object):
 
     def add_body(self, cog, vel, mass):
         self.root_node.bodies.append(Body(cog, vel, mass))
+        self.tree_built = False
 
     def print_children(self, node):
         print('node %s' % node.__dict__)
@@ -209,3 +397,88 @@ class Engine(object):
         for child in node.children:
             yield from self.traverse_node(child)
         #print('called!')
+
+    def iter_nodes(self, node=None, max_depth=None):
+        '''
+        Iterate over node (default root_node) and all nodes below in the same
+        order as traverse_node, but without recursion. Nodes deeper than
+        max_depth levels below node are skipped, e.g. for level of detail.
+        '''
+        self.build_tree()
+        stack = [(node if node is not None else self.root_node, 0)]
+        while stack:
+            node, depth = stack.pop()
+            yield node
+            if max_depth is None or depth < max_depth:
+                stack.extend((child, depth + 1) for child in reversed(node.children))
+
+    def query_rect(self, pos, width, height):
+        '''
+        Bodies with pos[0] <= x < pos[0] + width and pos[1] <= y < pos[1] + height
+        '''
+        self.build_tree()
+        x1 = pos[0] + width
+        y1 = pos[1] + height
+        result = []
+        stack = [self.root_node]
+        while stack:
+            node = stack.pop()
+            if (node.pos[0] >= x1 or node.pos[0] + node.size <= pos[0] or
+                    node.pos[1] >= y1 or node.pos[1] + node.size <= pos[1]):
+                continue
+            if not node.children:
+                result.extend(
+                    body for body in node.bodies
+                    if pos[0] <= body.cog[0] < x1 and pos[1] <= body.cog[1] < y1
+                )
+            elif (node.pos[0] >= pos[0] and node.pos[0] + node.size <= x1 and
+                    node.pos[1] >= pos[1] and node.pos[1] + node.size <= y1):
+                result.extend(node.bodies)
+            else:
+                stack.extend(node.children)
+        return result
+
+    def query_radius(self, point, radius):
+        '''
+        Bodies with a distance of at most radius to point
+        '''
+        self.build_tree()
+        result = []
+        stack = [self.root_node]
+        while stack:
+            node = stack.pop()
+            if node.min_distance(point) > radius:
+                continue
+            if not node.children:
+                result.extend(
+                    body for body in node.bodies
+                    if self.calc_distance(body.cog, point)[0] <= radius
+                )
+            elif node.max_distance(point) <= radius:
+                result.extend(node.bodies)
+            else:
+                stack.extend(node.children)
+        return result
+
+    def query_nearest(self, point, k=1):
+        '''
+        The k bodies closest to point, closest first
+        '''
+        self.build_tree()
+        result = []
+        # (distance, tie breaker, is_body, node or body)
+        heap = [(self.root_node.min_distance(point), 0, False, self.root_node)]
+        counter = 1
+        while heap and len(result) < k:
+            _, _, is_body, item = heapq.heappop(heap)
+            if is_body:
+                result.append(item)
+            elif not item.children:
+                for body in item.bodies:
+                    heapq.heappush(heap, (self.calc_distance(body.cog, point)[0], counter, True, body))
+                    counter += 1
+            else:
+                for child in item.children:
+                    heapq.heappush(heap, (child.min_distance(point), counter, False, child))
+                    counter += 1
+        return result
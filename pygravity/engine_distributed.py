@@ -0,0 +1,409 @@
+'''
+Distributed Barnes-Hut n-body engine
+
+Space is split into one domain per worker process using orthogonal recursive
+bisection (ORB): the longer side of a box is cut at the median body
+coordinate until there is one box per worker. Each tick takes two rounds of
+messages between the coordinator (Engine) and its workers:
+
+1) tree: every worker adopts bodies migrating into its domain, builds a
+Barnes-Hut tree from its own bodies and answers with one essential tree per
+other domain. An essential tree holds all nodes far enough from the other
+domain to be used as a whole (same phi criterion as force_traverse), opened
+down to single bodies where they are not.
+
+2) step: the coordinator forwards all essential trees to their domain.
+Workers insert them as ghosts into their tree, move their own bodies and
+answer with the bodies which have left their domain.
+
+Every rebalance ticks the domains are recalculated first. Workers only send
+their body count and a sample of body positions, the coordinator bisects
+using the samples weighted by those counts and workers hand over the bodies
+which are outside of their new domain.
+
+Messages are routed through the coordinator by a transport, see PipeTransport
+and SocketTransport. All workers run on the local host, any object providing
+send, recv and close may be used to talk to remote workers instead.
+
+Known differences to the single process engine: collisions between bodies of
+different domains are resolved on both sides independently, and bodies are
+moved in parallel per domain instead of one after another.
+'''
+
+import multiprocessing
+import pickle
+import socket
+import struct
+
+from pygravity.engine_bh import Body, Node, Engine as LocalEngine
+
+
+class PipeTransport(object):
+    '''
+    Transport using multiprocessing pipes
+    '''
+
+    def __init__(self, connection):
+        self.connection = connection
+
+    @classmethod
+    def pair(cls):
+        end1, end2 = multiprocessing.Pipe()
+        return cls(end1), cls(end2)
+
+    def send(self, message):
+        self.connection.send(message)
+
+    def recv(self):
+        return self.connection.recv()
+
+    def close(self):
+        self.connection.close()
+
+
+class SocketTransport(object):
+    '''
+    Transport using a pair of connected unix sockets, messages are pickled and
+    prefixed by their length
+    '''
+
+    header = struct.Struct('!Q')
+
+    def __init__(self, sock):
+        self.sock = sock
+
+    @classmethod
+    def pair(cls):
+        sock1, sock2 = socket.socketpair()
+        return cls(sock1), cls(sock2)
+
+    def send(self, message):
+        data = pickle.dumps(message, pickle.HIGHEST_PROTOCOL)
+        self.sock.sendall(self.header.pack(len(data)) + data)
+
+    def recv(self):
+        size, = self.header.unpack(self.recv_exact(self.header.size))
+        return pickle.loads(self.recv_exact(size))
+
+    def recv_exact(self, size):
+        chunks = []
+        while size:
+            chunk = self.sock.recv(min(size, 1 << 20))
+            if not chunk:
+                raise EOFError('Transport closed')
+            chunks.append(chunk)
+            size -= len(chunk)
+        return b''.join(chunks)
+
+    def close(self):
+        self.sock.close()
+
+
+class Ghost(object):
+    '''
+    Summary of a remote tree node, acts like a body without velocity. It is
+    no Body instance, so calc_force never runs collisions against it.
+    '''
+
+    def __init__(self, cog, mass):
+        self.cog = cog
+        self.mass = mass
+
+
+def body_state(body):
+    return body.cog, body.vel, body.mass
+
+
+def domain_contains(domain, cog):
+    return domain[0] <= cog[0] < domain[2] and domain[1] <= cog[1] < domain[3]
+
+
+def domain_distance(domain, cog):
+    '''
+    Distance from cog to the closest point of domain, 0 if inside
+    '''
+    delta_x = max(domain[0] - cog[0], 0, cog[0] - domain[2])
+    delta_y = max(domain[1] - cog[1], 0, cog[1] - domain[3])
+    return (delta_x ** 2 + delta_y ** 2) ** 0.5
+
+
+def bisect_domains(domain, cogs, count, weights=None):
+    '''
+    Orthogonal recursive bisection of domain into count boxes holding roughly
+    the same weight of cogs (default 1 each). Boxes are (x0, y0, x1, y1), x1
+    and y1 exclusive.
+    '''
+    if count == 1:
+        return [domain]
+    if weights is None:
+        weights = [1] * len(cogs)
+    axis = 0 if domain[2] - domain[0] >= domain[3] - domain[1] else 1
+    lower_count = count // 2
+    if cogs:
+        # weighted median, first coordinate reaching the lower share
+        ordered = sorted(zip((cog[axis] for cog in cogs), weights))
+        share = sum(weights) * lower_count / count
+        total = 0
+        for split, weight in ordered:
+            total += weight
+            if total > share:
+                break
+    else:
+        split = domain[axis] + (domain[axis + 2] - domain[axis]) * lower_count / count
+    split = min(max(split, domain[axis]), domain[axis + 2])
+
+    lower = list(domain)
+    upper = list(domain)
+    lower[axis + 2] = split
+    upper[axis] = split
+    lower_cogs = [(c, w) for c, w in zip(cogs, weights) if c[axis] < split]
+    upper_cogs = [(c, w) for c, w in zip(cogs, weights) if c[axis] >= split]
+    return (
+        bisect_domains(tuple(lower), [c for c, _ in lower_cogs], lower_count,
+                       [w for _, w in lower_cogs]) +
+        bisect_domains(tuple(upper), [c for c, _ in upper_cogs], count - lower_count,
+                       [w for _, w in upper_cogs])
+    )
+
+
+def essential_tree(engine, node, domain, leaves, ghosts):
+    '''
+    Collect the parts of the tree below node needed to calculate forces for
+    bodies inside of domain. Mirrors the decisions of force_traverse for the
+    closest possible body of the domain.
+    '''
+    if not node.bodies:
+        return
+    if len(node.bodies) == 1:
+        leaves.append(body_state(node.bodies[0]))
+        return
+    dist = domain_distance(domain, node.cog)
+    if dist and node.size / dist < engine.phi:
+        ghosts.append((node.cog, node.mass))
+        return
+    for child in node.children:
+        essential_tree(engine, child, domain, leaves, ghosts)
+
+
+def run_worker(transport, size, phi, collision_mode):
+    '''
+    Worker process main loop, owns the bodies of one domain
+    '''
+    engine = LocalEngine(size, phi=phi, collision_mode=collision_mode)
+    bodies = []
+    domains = None
+    index = None
+
+    while True:
+        message = transport.recv()
+        command = message[0]
+
+        if command == 'sample':
+            # evenly spaced sample of body positions
+            _, samples = message
+            step = max(len(bodies) // samples, 1)
+            transport.send((len(bodies), [b.cog for b in bodies[::step]]))
+
+        elif command == 'migrate':
+            _, domains, index = message
+            migrants = [
+                body_state(b) for b in bodies
+                if not domain_contains(domains[index], b.cog)
+            ]
+            bodies = [b for b in bodies if domain_contains(domains[index], b.cog)]
+            transport.send(migrants)
+
+        elif command == 'tree':
+            _, domains, index, incoming = message
+            bodies.extend(Body(*state) for state in incoming)
+            engine.root_node = Node((0, 0), size)
+            engine.root_node.bodies = bodies
+            engine.init_children(engine.root_node)
+            # bodies outside of space have been dropped by the root node
+            bodies = engine.root_node.bodies
+            essentials = []
+            for other, domain in enumerate(domains):
+                leaves = []
+                ghosts = []
+                if other != index:
+                    essential_tree(engine, engine.root_node, domain, leaves, ghosts)
+                essentials.append((leaves, ghosts))
+            transport.send(essentials)
+
+        elif command == 'step':
+            _, leaves, ghosts = message
+            engine.root_node = Node((0, 0), size)
+            engine.root_node.bodies = bodies + [
+                Body(*state) for state in leaves
+            ] + [
+                Ghost(cog, mass) for cog, mass in ghosts
+            ]
+            engine.init_children(engine.root_node)
+            for body in bodies:
+                engine.move_body(body)
+            bodies = [b for b in bodies if not b.remove]
+
+            migrants = [
+                body_state(b) for b in bodies
+                if not domain_contains(domains[index], b.cog)
+            ]
+            bodies = [b for b in bodies if domain_contains(domains[index], b.cog)]
+            transport.send(migrants)
+
+        elif command == 'bodies':
+            transport.send([body_state(b) for b in bodies])
+
+        elif command == 'stop':
+            transport.close()
+            return
+
+
+class Engine(object):
+    '''
+    Coordinator of a distributed Barnes-Hut simulation, exposing the same
+    add_body/tick API as pygravity.engine_bh.Engine. Bodies live in the
+    worker processes, root_node copies all of them to the coordinator on
+    each access and is meant for inspection and drawing only.
+
+    size       -- float, the engines space size
+    phi        -- float, the engines accuracy (default 0.5)
+    workers    -- int, number of worker processes / domains (default 2)
+    transport  -- string or transport class, see transports (default 'pipe')
+    rebalance  -- int, recalculate domains every n ticks (default 10)
+    samples    -- int, body positions sampled per worker to recalculate
+                  domains (default 256)
+    '''
+
+    transports = {
+        'pipe': PipeTransport,
+        'socket': SocketTransport,
+    }
+
+    def __init__(self, size, phi=0.5, collision_mode='elastic', workers=2,
+                 transport='pipe', rebalance=10, samples=256):
+        self.size = size
+        self.phi = phi
+        self.collision_mode = collision_mode
+        assert rebalance >= 1, 'Invalid rebalance!'
+        self.rebalance = rebalance
+        self.samples = samples
+        self.ticks = 0
+        self.pending = []
+        self.domains = bisect_domains((0, 0, size, size), [], workers)
+
+        if isinstance(transport, str):
+            assert transport in self.transports, 'Invalid transport!'
+            transport = self.transports[transport]
+
+        self.connections = []
+        self.processes = []
+        for _ in range(workers):
+            local_end, worker_end = transport.pair()
+            process = multiprocessing.Process(
+                target=run_worker,
+                args=(worker_end, size, phi, collision_mode),
+                daemon=True,
+            )
+            process.start()
+            self.connections.append(local_end)
+            self.processes.append(process)
+
+    def owner(self, cog):
+        for index, domain in enumerate(self.domains):
+            if domain_contains(domain, cog):
+                return index
+        return None
+
+    def gather(self):
+        '''
+        Fetch body states (cog, vel, mass) of all workers and pending bodies
+        '''
+        for connection in self.connections:
+            connection.send(('bodies',))
+        states = list(self.pending)
+        for connection in self.connections:
+            states.extend(connection.recv())
+        return states
+
+    def balance(self):
+        '''
+        Recalculate domains from samples of all workers and pending bodies,
+        returns the bodies workers had to give up
+        '''
+        for connection in self.connections:
+            connection.send(('sample', self.samples))
+        cogs = [state[0] for state in self.pending]
+        weights = [1] * len(cogs)
+        for connection in self.connections:
+            count, sample = connection.recv()
+            cogs.extend(sample)
+            # each sampled body stands for count / len(sample) bodies
+            weights.extend([count / len(sample)] * len(sample) if sample else [])
+        self.domains = bisect_domains(
+            (0, 0, self.size, self.size), cogs, len(self.connections), weights
+        )
+
+        for index, connection in enumerate(self.connections):
+            connection.send(('migrate', self.domains, index))
+        migrants = []
+        for connection in self.connections:
+            migrants.extend(connection.recv())
+        return migrants
+
+    def tick(self):
+        incoming = self.pending
+        if self.ticks % self.rebalance == 0:
+            incoming = incoming + self.balance()
+        self.pending = []
+
+        routed = [[] for _ in self.connections]
+        for state in incoming:
+            index = self.owner(state[0])
+            if index is not None:
+                routed[index].append(state)
+
+        for index, connection in enumerate(self.connections):
+            connection.send(('tree', self.domains, index, routed[index]))
+        essentials = [connection.recv() for connection in self.connections]
+
+        for index, connection in enumerate(self.connections):
+            leaves = []
+            ghosts = []
+            for other in essentials:
+                leaves.extend(other[index][0])
+                ghosts.extend(other[index][1])
+            connection.send(('step', leaves, ghosts))
+        for connection in self.connections:
+            # bodies leaving space are dropped like in the local engine
+            self.pending.extend(
+                state for state in connection.recv()
+                if self.owner(state[0]) is not None
+            )
+
+        self.ticks += 1
+
+    def add_body(self, cog, vel, mass):
+        self.pending.append((cog, vel, mass))
+
+    @property
+    def root_node(self):
+        '''
+        Root node holding copies of all bodies, gathered from all workers on
+        each access. Changes to these bodies are not sent back to the
+        workers.
+        '''
+        node = Node((0, 0), self.size)
+        node.bodies = [Body(*state) for state in self.gather()]
+        return node
+
+    def close(self):
+        '''
+        Stop all worker processes
+        '''
+        for connection in self.connections:
+            connection.send(('stop',))
+            connection.close()
+        for process in self.processes:
+            process.join()
+        self.connections = []
+        self.processes = []
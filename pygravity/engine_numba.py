@@ -0,0 +1,416 @@
+'''
+Barnes-Hut n-body engine compiled just in time by numba
+
+Same algorithm and collision handling as pygravity.engine_bh, but bodies and
+tree live in numpy arrays and tree build, force traversal and integration are
+numba kernels. No C compiler is needed at install time. Compiled kernels are
+cached on disk (next to this module, or in NUMBA_CACHE_DIR if set), so only
+the first run on a host pays for compilation.
+
+The tree is stored as flat arrays indexed by node number, children are
+always allocated after their parent. Leaves hold a linked list of bodies,
+which only grows beyond one body for bodies closer than MAX_DEPTH levels can
+separate.
+
+With precision 'single' positions, masses and the node arrays are float32, so
+the traversal moves half the memory and evaluates forces in float32. Force
+sums, centers of gravity and velocities are still accumulated in float64.
+See README for error bounds.
+'''
+
+import time
+
+import numpy as np
+from numba import njit
+
+from pygravity.engine_bh import Body, Node
+
+
+MAX_DEPTH = 48
+
+COLLISION_MODES = {
+    'elastic': 0,
+    'inelastic': 1,
+}
+
+PRECISIONS = {
+    'double': np.float64,
+    'single': np.float32,
+}
+
+
+@njit(cache=True)
+def build_tree(cog, remove, size, child, node_pos, node_size, leaf_body, next_body):
+    '''
+    Insert all bodies into the tree, returns number of nodes used or -1 if
+    the node arrays are too small. Bodies outside of space are removed.
+    '''
+    child[:] = -1
+    leaf_body[:] = -1
+    next_body[:] = -1
+    capacity = child.shape[0]
+    node_pos[0, 0] = 0
+    node_pos[0, 1] = 0
+    node_size[0] = size
+    nodes = 1
+
+    for body in range(cog.shape[0]):
+        if remove[body]:
+            continue
+        if not (0 <= cog[body, 0] < size and 0 <= cog[body, 1] < size):
+            remove[body] = True
+            continue
+        node = 0
+        depth = 0
+        while True:
+            half = node_size[node] / 2
+            if child[node, 0] != -1:
+                quadrant = 0
+                if cog[body, 0] >= node_pos[node, 0] + half:
+                    quadrant += 1
+                if cog[body, 1] >= node_pos[node, 1] + half:
+                    quadrant += 2
+                node = child[node, quadrant]
+                depth += 1
+            elif leaf_body[node] == -1:
+                leaf_body[node] = body
+                break
+            elif depth >= MAX_DEPTH:
+                next_body[body] = leaf_body[node]
+                leaf_body[node] = body
+                break
+            else:
+                # split leaf, move its body down one level and retry
+                if nodes + 4 > capacity:
+                    return -1
+                for quadrant in range(4):
+                    child[node, quadrant] = nodes
+                    node_pos[nodes, 0] = node_pos[node, 0] + half * (quadrant % 2)
+                    node_pos[nodes, 1] = node_pos[node, 1] + half * (quadrant // 2)
+                    node_size[nodes] = half
+                    nodes += 1
+                other = leaf_body[node]
+                leaf_body[node] = -1
+                quadrant = 0
+                if cog[other, 0] >= node_pos[node, 0] + half:
+                    quadrant += 1
+                if cog[other, 1] >= node_pos[node, 1] + half:
+                    quadrant += 2
+                leaf_body[child[node, quadrant]] = other
+    return nodes
+
+
+@njit(cache=True)
+def calc_cogs(cog, mass, nodes, child, node_pos, node_size, leaf_body, next_body,
+              node_mass, node_cog):
+    '''
+    Mass and center of gravity of all nodes, children first
+    '''
+    for node in range(nodes - 1, -1, -1):
+        total = 0.0
+        cog_x = 0.0
+        cog_y = 0.0
+        if child[node, 0] == -1:
+            body = leaf_body[node]
+            while body != -1:
+                total += mass[body]
+                cog_x += cog[body, 0] * mass[body]
+                cog_y += cog[body, 1] * mass[body]
+                body = next_body[body]
+        else:
+            for quadrant in range(4):
+                sub = child[node, quadrant]
+                total += node_mass[sub]
+                cog_x += node_cog[sub, 0] * node_mass[sub]
+                cog_y += node_cog[sub, 1] * node_mass[sub]
+        node_mass[node] = total
+        if total:
+            node_cog[node, 0] = cog_x / total
+            node_cog[node, 1] = cog_y / total
+        else:
+            node_cog[node, 0] = node_pos[node, 0] + node_size[node] / 2
+            node_cog[node, 1] = node_pos[node, 1] + node_size[node] / 2
+
+
+@njit(cache=True)
+def collide(body1, body2, vel, mass, remove, collision, mode):
+    if mode == 0:
+        # elastic, both bodies survive
+        if collision[body1] or collision[body2]:
+            return
+        mass_sum = mass[body1] + mass[body2]
+        for axis in range(2):
+            vel1 = vel[body1, axis]
+            vel2 = vel[body2, axis]
+            vel[body1, axis] = ((mass[body1] - mass[body2]) / mass_sum) * vel1 + ((2 * mass[body2]) / mass_sum) * vel2
+            vel[body2, axis] = ((mass[body2] - mass[body1]) / mass_sum) * vel2 + ((2 * mass[body1]) / mass_sum) * vel1
+        collision[body1] = True
+        collision[body2] = True
+    else:
+        # inelastic, the heavier body eats the other one
+        if remove[body1] or remove[body2]:
+            return
+        if mass[body1] > mass[body2]:
+            keep = body1
+            kill = body2
+        else:
+            keep = body2
+            kill = body1
+        remove[kill] = True
+        mass_sum = mass[keep] + mass[kill]
+        for axis in range(2):
+            vel[keep, axis] = (vel[keep, axis] * mass[keep] + vel[kill, axis] * mass[kill]) / mass_sum
+        mass[keep] = mass_sum
+
+
+@njit(cache=True)
+def move_bodies(cog, vel, mass, fixed, remove, collision, phi, mode, timestep,
+                child, node_size, leaf_body, next_body, node_mass, node_cog):
+    '''
+    Traverse the tree for each body and apply the resulting force for one
+    timestep, bodies are moved one after another like in engine_bh
+    '''
+    stack = np.empty(4 * MAX_DEPTH + 4, dtype=np.int64)
+    for body in range(cog.shape[0]):
+        collision[body] = False
+        if remove[body] or fixed[body]:
+            continue
+        force_x = 0.0
+        force_y = 0.0
+        stack[0] = 0
+        depth = 1
+        while depth:
+            depth -= 1
+            node = stack[depth]
+            if remove[body]:
+                break
+            if child[node, 0] == -1:
+                other = leaf_body[node]
+                while other != -1:
+                    if other != body and not remove[other]:
+                        delta_x = cog[body, 0] - cog[other, 0]
+                        delta_y = cog[body, 1] - cog[other, 1]
+                        dist = np.sqrt(delta_x ** 2 + delta_y ** 2)
+                        if dist <= 2:
+                            collide(body, other, vel, mass, remove, collision, mode)
+                        else:
+                            force = (mass[body] * mass[other]) / (dist ** 2)
+                            force_x += force * delta_x / dist
+                            force_y += force * delta_y / dist
+                    other = next_body[other]
+                continue
+            delta_x = cog[body, 0] - node_cog[node, 0]
+            delta_y = cog[body, 1] - node_cog[node, 1]
+            dist = np.sqrt(delta_x ** 2 + delta_y ** 2)
+            if not dist:
+                # float32 keeps single precision runs in float32
+                dist = np.float32(.5)
+            if node_size[node] / dist < phi:
+                force = (mass[body] * node_mass[node]) / (dist ** 2)
+                force_x += force * delta_x / dist
+                force_y += force * delta_y / dist
+            else:
+                # visit children nw, ne, se, sw like engine_bh, collisions
+                # depend on that order
+                for quadrant in (0, 1, 3, 2):
+                    if node_mass[child[node, quadrant]]:
+                        stack[depth] = child[node, quadrant]
+                        depth += 1
+        if remove[body]:
+            continue
+        vel[body, 0] -= force_x / mass[body] * timestep
+        vel[body, 1] -= force_y / mass[body] * timestep
+        cog[body, 0] += vel[body, 0] * timestep
+        cog[body, 1] += vel[body, 1] * timestep
+
+
+@njit(cache=True)
+def calc_potential(cog, mass, remove, phi, child, node_size, leaf_body, next_body,
+                   node_mass, node_cog):
+    '''
+    Potential energy of all bodies using the tree, same phi criterion as
+    move_bodies and engine_bh.Engine.tree_potential
+    '''
+    stack = np.empty(4 * MAX_DEPTH + 4, dtype=np.int64)
+    potential = 0.0
+    for body in range(cog.shape[0]):
+        if remove[body]:
+            continue
+        stack[0] = 0
+        depth = 1
+        while depth:
+            depth -= 1
+            node = stack[depth]
+            if child[node, 0] == -1:
+                other = leaf_body[node]
+                while other != -1:
+                    if other != body:
+                        delta_x = cog[body, 0] - cog[other, 0]
+                        delta_y = cog[body, 1] - cog[other, 1]
+                        dist = np.sqrt(delta_x ** 2 + delta_y ** 2)
+                        if dist:
+                            potential -= mass[body] * mass[other] / dist
+                    other = next_body[other]
+                continue
+            delta_x = cog[body, 0] - node_cog[node, 0]
+            delta_y = cog[body, 1] - node_cog[node, 1]
+            dist = np.sqrt(delta_x ** 2 + delta_y ** 2)
+            if dist and node_size[node] / dist < phi:
+                potential -= mass[body] * node_mass[node] / dist
+            else:
+                for quadrant in range(4):
+                    if node_mass[child[node, quadrant]]:
+                        stack[depth] = child[node, quadrant]
+                        depth += 1
+    # each pair is seen from both bodies
+    return potential / 2
+
+
+class Engine(object):
+    '''
+    Array based Barnes-Hut engine, see pygravity.engine_bh for details
+
+    size           -- float, the engines space size
+    phi            -- float, the engines accuracy (default 0.5)
+    collision_mode -- string, 'elastic' or 'inelastic' (default 'elastic')
+    timestep       -- float, time per tick (default .1)
+    precision      -- string, 'double' or 'single' (default 'double')
+    diagnostics_interval -- int, calculate diagnostics every n ticks (default None, off)
+    '''
+
+    def __init__(self, size, phi=0.5, collision_mode='elastic', timestep=.1,
+                 precision='double', diagnostics_interval=None):
+        assert collision_mode in COLLISION_MODES, 'Invalid collision_mode!'
+        assert precision in PRECISIONS, 'Invalid precision!'
+        self.size = size
+        self.phi = phi
+        self.collision_mode = collision_mode
+        self.timestep = timestep
+        self.precision = precision
+        self.dtype = PRECISIONS[precision]
+
+        self.cog = np.zeros((0, 2), dtype=self.dtype)
+        self.vel = np.zeros((0, 2))
+        self.mass = np.zeros(0, dtype=self.dtype)
+        self.fixed = np.zeros(0, dtype=np.bool_)
+        # like Body.collision, flags are kept until the body's next turn
+        self.collision = np.zeros(0, dtype=np.bool_)
+        self.pending = []
+        self.capacity = 0
+        self.ticks = 0
+
+        # energy and momentum are calculated every diagnostics_interval ticks
+        self.diagnostics_interval = diagnostics_interval
+        self.diagnostics = None
+
+    def allocate_tree(self, capacity):
+        self.capacity = capacity
+        self.child = np.empty((capacity, 4), dtype=np.int64)
+        self.node_pos = np.empty((capacity, 2))
+        self.node_size = np.empty(capacity, dtype=self.dtype)
+        self.node_mass = np.empty(capacity, dtype=self.dtype)
+        self.node_cog = np.empty((capacity, 2), dtype=self.dtype)
+        self.leaf_body = np.empty(capacity, dtype=np.int64)
+
+    def add_pending(self):
+        if not self.pending:
+            return
+        cog, vel, mass, fixed = zip(*self.pending)
+        self.cog = np.concatenate([self.cog, np.array(cog, dtype=self.dtype)])
+        self.vel = np.concatenate([self.vel, np.array(vel, dtype=float)])
+        self.mass = np.concatenate([self.mass, np.array(mass, dtype=self.dtype)])
+        self.fixed = np.concatenate([self.fixed, np.array(fixed, dtype=np.bool_)])
+        self.collision = np.concatenate([self.collision, np.zeros(len(mass), dtype=np.bool_)])
+        self.pending = []
+
+    def prepare_tree(self):
+        '''
+        Build the tree for current positions, returns the flags of bodies
+        outside of space and the linked lists of bodies sharing a leaf
+        '''
+        self.add_pending()
+        bodies = len(self.mass)
+        remove = np.zeros(bodies, dtype=np.bool_)
+        next_body = np.empty(bodies, dtype=np.int64)
+
+        if self.capacity < 4 * bodies + 8:
+            self.allocate_tree(4 * bodies + 8)
+        while True:
+            nodes = build_tree(
+                self.cog, remove, self.size, self.child, self.node_pos,
+                self.node_size, self.leaf_body, next_body
+            )
+            if nodes != -1:
+                break
+            self.allocate_tree(2 * self.capacity)
+
+        calc_cogs(
+            self.cog, self.mass, nodes, self.child, self.node_pos,
+            self.node_size, self.leaf_body, next_body, self.node_mass,
+            self.node_cog
+        )
+        return remove, next_body
+
+    def calc_diagnostics(self):
+        '''
+        Total energy, momentum and angular momentum (around origin) of all
+        bodies inside of space, see engine_bh.Engine.calc_diagnostics.
+        Potential energy is approximated using the tree.
+        '''
+        start = time.perf_counter()
+        remove, next_body = self.prepare_tree()
+        potential = calc_potential(
+            self.cog, self.mass, remove, self.phi, self.child, self.node_size,
+            self.leaf_body, next_body, self.node_mass, self.node_cog
+        )
+        keep = ~remove
+        cog = self.cog[keep].astype(np.float64)
+        vel = self.vel[keep]
+        mass = self.mass[keep].astype(np.float64)
+        kinetic = (mass * (vel ** 2).sum(axis=1)).sum() / 2
+        momentum = (mass[:, None] * vel).sum(axis=0)
+        angular_momentum = (mass * (cog[:, 0] * vel[:, 1] - cog[:, 1] * vel[:, 0])).sum()
+        return {
+            'kinetic': float(kinetic),
+            'potential': float(potential),
+            'energy': float(kinetic + potential),
+            'momentum': (float(momentum[0]), float(momentum[1])),
+            'angular_momentum': float(angular_momentum),
+            'time': time.perf_counter() - start,
+        }
+
+    def tick(self):
+        remove, next_body = self.prepare_tree()
+        move_bodies(
+            self.cog, self.vel, self.mass, self.fixed, remove, self.collision,
+            self.phi, COLLISION_MODES[self.collision_mode], self.timestep,
+            self.child, self.node_size, self.leaf_body, next_body,
+            self.node_mass, self.node_cog
+        )
+
+        keep = ~remove
+        self.cog = self.cog[keep]
+        self.vel = self.vel[keep]
+        self.mass = self.mass[keep]
+        self.fixed = self.fixed[keep]
+        self.collision = self.collision[keep]
+        self.ticks += 1
+        if self.diagnostics_interval and self.ticks % self.diagnostics_interval == 0:
+            self.diagnostics = self.calc_diagnostics()
+
+    def add_body(self, cog, vel, mass, fixed=False):
+        self.pending.append((cog, vel, mass, fixed))
+
+    @property
+    def root_node(self):
+        '''
+        Root node holding copies of all bodies, changes to these bodies are
+        not applied to the engine
+        '''
+        self.add_pending()
+        node = Node((0, 0), self.size)
+        node.bodies = [
+            Body(tuple(cog), tuple(vel), mass)
+            for cog, vel, mass in zip(self.cog.tolist(), self.vel.tolist(), self.mass.tolist())
+        ]
+        return node
@@ -0,0 +1,308 @@
+'''
+Particle-mesh n-body engine
+
+Instead of walking a tree for every body, mass is deposited onto a grid
+using cloud-in-cell (CIC) weights, the potential of the grid is calculated by
+a FFT convolution and accelerations are interpolated back to the bodies using
+the same weights. One tick costs about O(N + G log G) for N bodies on a grid
+of G points, which pays off for many bodies spread rather evenly.
+
+Forces follow the same law as the Barnes-Hut engines (m1 * m2 / r ** 2 in the
+plane), so the potential kernel is -1 / r instead of the Green's function of
+the 2D Poisson equation. The grid is zero padded to twice its size, so space
+is not periodic.
+
+The mesh can not resolve distances below a few cells. With short_range set,
+the kernel is split: the mesh only handles the smooth long range part and
+pairs closer than cutoff cells are added directly (TreePM/P3M style), found
+using a chaining mesh of cutoff sized cells.
+
+Bodies are stored in numpy arrays, there are no collisions. With precision
+'single' positions, masses, the density grid and the FFT are float32, which
+halves memory traffic of the mesh. Accelerations and velocities are still
+summed in float64. See README for error bounds.
+'''
+
+import math
+import time
+
+import numpy as np
+
+from pygravity.engine_bh import Body, Node
+
+
+PRECISIONS = {
+    'double': np.float64,
+    'single': np.float32,
+}
+
+class Engine(object):
+    '''
+    size        -- float, the engines space size
+    grid        -- int, number of mesh cells per side (default 256)
+    short_range -- bool, add close pairs directly (default False)
+    cutoff      -- float, short range cutoff in cells (default 4)
+    timestep    -- float, time per tick (default .1)
+    precision   -- string, 'double' or 'single' (default 'double')
+    diagnostics_interval -- int, calculate diagnostics every n ticks (default None, off)
+    '''
+
+    def __init__(self, size, grid=256, short_range=False, cutoff=4, timestep=.1,
+                 precision='double', diagnostics_interval=None):
+        assert precision in PRECISIONS, 'Invalid precision!'
+        self.size = size
+        self.grid = grid
+        self.cell_size = size / grid
+        self.short_range = short_range
+        self.cutoff = cutoff * self.cell_size
+        self.timestep = timestep
+        self.precision = precision
+        self.dtype = PRECISIONS[precision]
+
+        self.cog = np.zeros((0, 2), dtype=self.dtype)
+        self.vel = np.zeros((0, 2))
+        self.mass = np.zeros(0, dtype=self.dtype)
+        self.fixed = np.zeros(0, dtype=bool)
+        self.pending = []
+        self.ticks = 0
+
+        # energy and momentum are calculated every diagnostics_interval ticks
+        self.diagnostics_interval = diagnostics_interval
+        self.diagnostics = None
+
+        kernel = self.calc_kernel()
+        self.kernel = np.fft.rfft2(kernel.astype(self.dtype))
+        # kernel between neighbouring mesh points, for the CIC self energy
+        self.near_kernel = {
+            (dx, dy): kernel[dx, dy] for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+        }
+
+    def calc_kernel(self):
+        '''
+        Potential of a unit mass for all mesh offsets of the padded grid,
+        offsets beyond grid wrap around to negative ones
+        '''
+        padded = 2 * self.grid
+        offsets = np.arange(padded)
+        offsets = np.minimum(offsets, padded - offsets) * self.cell_size
+        dist = np.hypot(offsets[:, None], offsets[None, :])
+        dist[0, 0] = 1
+        kernel = -1 / dist
+        if self.short_range:
+            # remove the part added back by short_range_acceleration
+            close = dist < self.cutoff
+            kernel[close] += (1 - dist[close] / self.cutoff) ** 2 / dist[close]
+            kernel[0, 0] = -2 / self.cutoff
+        else:
+            # mean of -1 / r over one cell
+            kernel[0, 0] = -4 * math.log(1 + math.sqrt(2)) / self.cell_size
+        return kernel
+
+    def cic_weights(self):
+        '''
+        Mesh indices (lower left corner) and CIC weights of all bodies
+        '''
+        scaled = self.cog / self.cell_size
+        index = np.clip(np.floor(scaled).astype(int), 0, self.grid - 1)
+        frac = scaled - index
+        return index, frac
+
+    def cic_corners(self):
+        '''
+        Mesh indices and CIC weights of all bodies as (offset_x, offset_y,
+        weight) per corner of their cell
+        '''
+        index, frac = self.cic_weights()
+        return index, [
+            (0, 0, (1 - frac[:, 0]) * (1 - frac[:, 1])),
+            (1, 0, frac[:, 0] * (1 - frac[:, 1])),
+            (0, 1, (1 - frac[:, 0]) * frac[:, 1]),
+            (1, 1, frac[:, 0] * frac[:, 1]),
+        ]
+
+    def mesh_potential(self, index, corners):
+        '''
+        Potential of the mesh points, calculated by a FFT convolution of the
+        CIC mass density with the kernel
+        '''
+        padded = 2 * self.grid
+        density = np.zeros(padded * padded)
+        for offset_x, offset_y, weight in corners:
+            flat = (index[:, 0] + offset_x) * padded + index[:, 1] + offset_y
+            density += np.bincount(flat, weights=self.mass * weight, minlength=padded * padded)
+        density = density.reshape(padded, padded).astype(self.dtype)
+
+        potential = np.fft.irfft2(np.fft.rfft2(density) * self.kernel, s=density.shape)
+        return potential[:self.grid + 1, :self.grid + 1]
+
+    def mesh_acceleration(self):
+        index, corners = self.cic_corners()
+        potential = self.mesh_potential(index, corners)
+        grad_x, grad_y = np.gradient(potential, self.cell_size)
+
+        acceleration = np.zeros(self.cog.shape)
+        for offset_x, offset_y, weight in corners:
+            mesh_x = index[:, 0] + offset_x
+            mesh_y = index[:, 1] + offset_y
+            acceleration[:, 0] -= weight * grad_x[mesh_x, mesh_y]
+            acceleration[:, 1] -= weight * grad_y[mesh_x, mesh_y]
+        return acceleration
+
+    def close_pairs(self):
+        '''
+        Yield members of each cutoff sized cell, the bodies of its 3x3
+        neighbourhood, their position deltas, distances (1 where not close)
+        and a mask of pairs closer than cutoff
+        '''
+        cells = int(math.ceil(self.size / self.cutoff))
+        cell = np.floor(self.cog / self.cutoff).astype(int)
+        keys = cell[:, 0] * cells + cell[:, 1]
+        order = np.argsort(keys, kind='stable')
+        sorted_keys = keys[order]
+        occupied, starts, counts = np.unique(sorted_keys, return_index=True, return_counts=True)
+        members_of = {
+            key: order[start:start + count]
+            for key, start, count in zip(occupied.tolist(), starts, counts)
+        }
+
+        for key, members in members_of.items():
+            cell_x, cell_y = divmod(key, cells)
+            neighbours = [
+                members_of[(cell_x + dx) * cells + cell_y + dy]
+                for dx in (-1, 0, 1) for dy in (-1, 0, 1)
+                if 0 <= cell_x + dx < cells and 0 <= cell_y + dy < cells and
+                (cell_x + dx) * cells + cell_y + dy in members_of
+            ]
+            neighbours = np.concatenate(neighbours)
+            delta = self.cog[members][:, None, :] - self.cog[neighbours][None, :, :]
+            dist = np.hypot(delta[..., 0], delta[..., 1])
+            close = (dist > 0) & (dist < self.cutoff)
+            dist = np.where(close, dist, 1)
+            yield members, neighbours, delta, dist, close
+
+    def short_range_acceleration(self):
+        '''
+        Acceleration by all bodies closer than cutoff, minus the part already
+        handled by the mesh. Bodies are sorted into cutoff sized cells, each
+        cell is compared against its 3x3 neighbourhood.
+        '''
+        acceleration = np.zeros(self.cog.shape)
+        for members, neighbours, delta, dist, close in self.close_pairs():
+            taper = 1 - dist / self.cutoff
+            # -d/dr of the short range potential -(1 - r / cutoff) ** 2 / r
+            force = taper ** 2 / dist ** 2 + 2 * taper / (self.cutoff * dist)
+            force = np.where(close, force * self.mass[neighbours][None, :] / dist, 0)
+            acceleration[members] -= (force[..., None] * delta).sum(axis=1)
+        return acceleration
+
+    def calc_acceleration(self):
+        '''
+        Acceleration of all bodies for their current positions
+        '''
+        acceleration = self.mesh_acceleration()
+        if self.short_range:
+            acceleration += self.short_range_acceleration()
+        return acceleration
+
+    def short_range_potential(self):
+        '''
+        Potential energy of all pairs closer than cutoff not handled by the
+        mesh, each pair counted once
+        '''
+        potential = 0
+        for members, neighbours, delta, dist, close in self.close_pairs():
+            pair = (1 - dist / self.cutoff) ** 2 / dist
+            mass = self.mass[members][:, None] * self.mass[neighbours][None, :]
+            potential -= np.where(close, pair * mass, 0).sum(dtype=np.float64)
+        return potential / 2
+
+    def calc_diagnostics(self):
+        '''
+        Total energy, momentum and angular momentum (around origin) of all
+        bodies, see engine_bh.Engine.calc_diagnostics. Potential energy is
+        read from the mesh, without the energy of each body's CIC cloud
+        against itself.
+        '''
+        start = time.perf_counter()
+        self.drop_outside()
+        cog = self.cog.astype(np.float64)
+        mass = self.mass.astype(np.float64)
+        vel = self.vel
+
+        index, corners = self.cic_corners()
+        potential = self.mesh_potential(index, corners)
+        at_body = np.zeros(len(mass))
+        self_potential = np.zeros(len(mass))
+        for offset_x, offset_y, weight in corners:
+            at_body += weight * potential[index[:, 0] + offset_x, index[:, 1] + offset_y]
+            for other_x, other_y, other_weight in corners:
+                near = self.near_kernel[(offset_x - other_x, offset_y - other_y)]
+                self_potential += weight * other_weight * near
+        # each pair is seen from both bodies
+        potential = (mass * (at_body - mass * self_potential)).sum() / 2
+        if self.short_range:
+            potential += self.short_range_potential()
+
+        kinetic = (mass * (vel ** 2).sum(axis=1)).sum() / 2
+        momentum = (mass[:, None] * vel).sum(axis=0)
+        angular_momentum = (mass * (cog[:, 0] * vel[:, 1] - cog[:, 1] * vel[:, 0])).sum()
+        return {
+            'kinetic': float(kinetic),
+            'potential': float(potential),
+            'energy': float(kinetic + potential),
+            'momentum': (float(momentum[0]), float(momentum[1])),
+            'angular_momentum': float(angular_momentum),
+            'time': time.perf_counter() - start,
+        }
+
+    def add_pending(self):
+        if not self.pending:
+            return
+        cog, vel, mass, fixed = zip(*self.pending)
+        self.cog = np.concatenate([self.cog, np.array(cog, dtype=self.dtype)])
+        self.vel = np.concatenate([self.vel, np.array(vel, dtype=float)])
+        self.mass = np.concatenate([self.mass, np.array(mass, dtype=self.dtype)])
+        self.fixed = np.concatenate([self.fixed, np.array(fixed, dtype=bool)])
+        self.pending = []
+
+    def drop_outside(self):
+        '''
+        Add pending bodies and drop bodies which have left space, like the
+        Barnes-Hut engines do
+        '''
+        self.add_pending()
+        inside = ((self.cog >= 0) & (self.cog < self.size)).all(axis=1)
+        if not inside.all():
+            self.cog = self.cog[inside]
+            self.vel = self.vel[inside]
+            self.mass = self.mass[inside]
+            self.fixed = self.fixed[inside]
+
+    def tick(self):
+        self.drop_outside()
+        if len(self.mass):
+            moving = ~self.fixed
+            acceleration = self.calc_acceleration()
+            self.vel[moving] += acceleration[moving] * self.timestep
+            self.cog[moving] += self.vel[moving] * self.timestep
+
+        self.ticks += 1
+        if self.diagnostics_interval and self.ticks % self.diagnostics_interval == 0:
+            self.diagnostics = self.calc_diagnostics()
+
+    def add_body(self, cog, vel, mass, fixed=False):
+        self.pending.append((cog, vel, mass, fixed))
+
+    @property
+    def root_node(self):
+        '''
+        Root node holding copies of all bodies, changes to these bodies are
+        not applied to the engine
+        '''
+        self.add_pending()
+        node = Node((0, 0), self.size)
+        node.bodies = [
+            Body(tuple(cog), tuple(vel), mass)
+            for cog, vel, mass in zip(self.cog.tolist(), self.vel.tolist(), self.mass.tolist())
+        ]
+        return node
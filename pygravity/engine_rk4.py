@@ -82,7 +82,7 @@ class Planet(object):
         )
         nextState.pos_x = initialState.pos_x + derivative.dx * dt
         nextState.pos_y = initialState.pos_y + derivative.dy * dt
-        nextState.vel_x = initialState.vel_x + derivative.dvy * dt
+        nextState.vel_x = initialState.vel_x + derivative.dvx * dt
         nextState.vel_y = initialState.vel_y + derivative.dvy * dt
         ax, ay = self.calc_acceleration(nextState, curtime+dt)
         return Derivative(
@@ -110,7 +110,9 @@ class Planet(object):
 
 class Engine(object):
 
-    def __init__(self):
+    def __init__(self, collision_mode='inelastic'):
+        # planets always merge, the argument matches the Barnes-Hut engines
+        assert collision_mode == 'inelastic', 'Invalid collision_mode!'
         self.cur_index = 0
         self.curtime = 0
         self.timerate = 1
@@ -125,6 +127,20 @@ class Engine(object):
         self.planets[self.cur_index] = new_planet
         return self.cur_index
 
+    def add_body(self, cog, vel, mass, fixed=False):
+        '''
+        Same signature as the Barnes-Hut engines, planets get density 1
+        '''
+        return self.add_planet(
+            pos_x=cog[0],
+            pos_y=cog[1],
+            density=1,
+            mass=mass,
+            vel_x=vel[0],
+            vel_y=vel[1],
+            fixed=fixed
+        )
+
     def remove_planet(self, index):
         del_planet = self.planets.get(index)
         if del_planet is not None:
@@ -98,7 +98,7 @@ def main():
             engine.tick()
 
         if draw_boxes:
-            for node in engine.traverse_node(engine.root_node):
+            for node in engine.iter_nodes():
                 node_surface = pygame.Surface((node.size, node.size))
                 pygame.draw.rect(
                     node_surface,
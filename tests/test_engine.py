@@ -1,9 +1,16 @@
+import math
 import unittest
 import time
+from unittest import mock
 
+from pygravity import backends
 from pygravity.engine_rk4 import Engine as RK4Engine
-from pygravity.engine_bh import Engine as BHEngine
-from engine_bh import Engine as CyBHEngine
+from pygravity.engine_bh import Body as BHBody, Engine as BHEngine
+from pygravity.engine_distributed import Engine as DistBHEngine, bisect_domains
+
+PMEngine = backends.load('pm')
+NumbaBHEngine = backends.load('numba')
+CyBHEngine = backends.load('cython')
 
 
 class RK4_EngineTest(unittest.TestCase):
@@ -67,7 +74,306 @@ class BH_EngineTest(unittest.TestCase):
                 end, len(test_engine.root_node.bodies))
             )
 
+    def test_tunePhi(self):
+        phis = []
+        for force_error in (1e-1, 1e-3):
+            test_engine = BHEngine(size=1000, force_error=force_error)
+            for i in range(300):
+                test_engine.add_body(
+                    cog=(i * 37 % 1000, i * 53 % 1000),
+                    vel=(0, 0),
+                    mass=1
+                )
+            test_engine.tick()
+            phis.append(test_engine.phi)
+            # error of all bodies at the tuned phi, measured by the python
+            # engine on the same positions
+            check_engine = BHEngine(size=1000)
+            for body in test_engine.root_node.bodies:
+                check_engine.add_body(cog=body.cog, vel=(0, 0), mass=1)
+            check_engine.build_tree()
+            bodies = check_engine.root_node.bodies
+            exact = [check_engine.exact_force(body) for body in bodies]
+            self.assertLessEqual(
+                check_engine.force_error_for(bodies, exact, test_engine.phi),
+                force_error
+            )
+        self.assertTrue(0 < phis[1] < phis[0] <= 2)
+
+    def test_queries(self):
+        test_engine = BHEngine(size=1000)
+        for i in range(500):
+            test_engine.add_body(
+                cog=(i * 37 % 1000, i * 53 % 1000),
+                vel=(0, 0),
+                mass=1
+            )
+        test_engine.tick()
+        bodies = test_engine.root_node.bodies
+        point = (420, 380)
+
+        found = test_engine.query_rect(point, 200, 100)
+        expected = [
+            b for b in bodies
+            if 420 <= b.cog[0] < 620 and 380 <= b.cog[1] < 480
+        ]
+        self.assertEqual(set(map(id, found)), set(map(id, expected)))
+
+        found = test_engine.query_radius(point, 150)
+        expected = [b for b in bodies if math.dist(b.cog, point) <= 150]
+        self.assertEqual(set(map(id, found)), set(map(id, expected)))
+
+        found = test_engine.query_nearest(point, 5)
+        expected = sorted(bodies, key=lambda b: math.dist(b.cog, point))[:5]
+        self.assertEqual(
+            [math.dist(b.cog, point) for b in found],
+            [math.dist(b.cog, point) for b in expected]
+        )
+
+        nodes = list(test_engine.iter_nodes())
+        self.assertEqual(
+            list(map(id, nodes)),
+            list(map(id, test_engine.traverse_node(test_engine.root_node)))
+        )
+        self.assertEqual(len(list(test_engine.iter_nodes(max_depth=1))), 5)
+
+        # bodies changed directly are found once the tree is invalidated
+        body = BHBody((421, 381), (0, 0), 1)
+        test_engine.root_node.bodies.append(body)
+        self.assertNotIn(body, test_engine.query_nearest(point, 1))
+        test_engine.invalidate_tree()
+        self.assertEqual(test_engine.query_nearest(point, 1), [body])
+
+        # the next tick reuses the tree built for queries
+        roots = []
+        init_children = test_engine.init_children
+
+        def count_roots(node):
+            if node is test_engine.root_node:
+                roots.append(node)
+            init_children(node)
+
+        test_engine.init_children = count_roots
+        test_engine.tick()
+        self.assertEqual(roots, [])
+        test_engine.query_nearest(point, 1)
+        self.assertEqual(len(roots), 1)
+
+    def test_diagnostics(self):
+        test_engine = BHEngine(size=1000, diagnostics_interval=1)
+        test_engine.add_body(cog=(100, 100), vel=(1, 0), mass=2)
+        test_engine.add_body(cog=(100, 200), vel=(0, 0), mass=3)
+        diagnostics = test_engine.calc_diagnostics()
+        self.assertAlmostEqual(diagnostics['kinetic'], 1)
+        self.assertAlmostEqual(diagnostics['potential'], -0.06)
+        self.assertAlmostEqual(diagnostics['energy'], 0.94)
+        self.assertEqual(diagnostics['momentum'], (2, 0))
+        self.assertAlmostEqual(diagnostics['angular_momentum'], -200)
+        test_engine.tick()
+        self.assertIsNotNone(test_engine.diagnostics)
+
+
+class DistBH_EngineTest(unittest.TestCase):
+
+    def compare_local(self, transport):
+        local_engine = BHEngine(size=1000)
+        test_engine = DistBHEngine(
+            size=1000,
+            workers=3,
+            transport=transport,
+            rebalance=2
+        )
+        for engine in (local_engine, test_engine):
+            for i in range(200):
+                engine.add_body(
+                    cog=(i * 37 % 800 + 100, i * 53 % 800 + 100),
+                    vel=(0, 0),
+                    mass=1 + i % 3
+                )
+        for i in range(3):
+            local_engine.tick()
+            test_engine.tick()
+        local_bodies = sorted(b.cog for b in local_engine.root_node.bodies)
+        dist_bodies = sorted(b.cog for b in test_engine.root_node.bodies)
+        test_engine.close()
+        self.assertEqual(len(local_bodies), len(dist_bodies))
+        for cog_l, cog_d in zip(local_bodies, dist_bodies):
+            self.assertAlmostEqual(cog_l[0], cog_d[0], delta=1e-3)
+            self.assertAlmostEqual(cog_l[1], cog_d[1], delta=1e-3)
+
+    def test_bisectWeights(self):
+        cogs = [(100, 500), (300, 500), (600, 500), (900, 500)]
+        domains = bisect_domains((0, 0, 1000, 1000), cogs, 2, [3, 1, 1, 1])
+        self.assertEqual(domains, [(0, 0, 300, 1000), (300, 0, 1000, 1000)])
+
+    def test_pipeTransport(self):
+        self.compare_local('pipe')
+
+    def test_socketTransport(self):
+        self.compare_local('socket')
+
+
+@unittest.skipUnless(PMEngine, 'numpy is not installed')
+class PM_EngineTest(unittest.TestCase):
+
+    def test_farForce(self):
+        test_engine = PMEngine(size=1000, grid=128)
+        test_engine.add_body(cog=(300, 400), vel=(0, 0), mass=1)
+        test_engine.add_body(cog=(700, 400), vel=(0, 0), mass=5)
+        test_engine.add_pending()
+        acceleration = test_engine.calc_acceleration()
+        self.assertAlmostEqual(acceleration[0][0], 5 / 400 ** 2, delta=1e-6)
+        self.assertAlmostEqual(acceleration[1][0], -1 / 400 ** 2, delta=1e-6)
+
+    def test_shortRange(self):
+        test_engine = PMEngine(size=1000, grid=128, short_range=True)
+        cogs = [(i * 37 % 400 + 300, i * 53 % 400 + 300) for i in range(300)]
+        for cog in cogs:
+            test_engine.add_body(cog=cog, vel=(0, 0), mass=1)
+        test_engine.add_pending()
+        acceleration = test_engine.calc_acceleration()
+        error = total = 0
+        for i, cog in enumerate(cogs[:20]):
+            exact_x = exact_y = 0
+            for other in cogs:
+                dist = math.dist(cog, other)
+                if dist:
+                    exact_x -= (cog[0] - other[0]) / dist ** 3
+                    exact_y -= (cog[1] - other[1]) / dist ** 3
+            error += (acceleration[i][0] - exact_x) ** 2 + (acceleration[i][1] - exact_y) ** 2
+            total += exact_x ** 2 + exact_y ** 2
+        self.assertLess(math.sqrt(error / total), .05)
+
+    def test_precisionSingle(self):
+        engines = [
+            PMEngine(size=1000, grid=128, precision='double'),
+            PMEngine(size=1000, grid=128, precision='single'),
+        ]
+        for test_engine in engines:
+            for i in range(300):
+                test_engine.add_body(
+                    cog=(i * 37 % 400 + 300, i * 53 % 400 + 300),
+                    vel=(0, 0),
+                    mass=1 + i % 3
+                )
+            test_engine.add_pending()
+        self.assertEqual(engines[1].cog.dtype.itemsize, 4)
+        double, single = [e.calc_acceleration() for e in engines]
+        error = ((double - single) ** 2).sum()
+        total = (double ** 2).sum()
+        self.assertLess(math.sqrt(error / total), 1e-4)
+
+    def test_diagnostics(self):
+        test_engine = PMEngine(size=1000, grid=128, diagnostics_interval=1)
+        test_engine.add_body(cog=(100, 100), vel=(1, 0), mass=2)
+        test_engine.add_body(cog=(100, 200), vel=(0, 0), mass=3)
+        diagnostics = test_engine.calc_diagnostics()
+        self.assertAlmostEqual(diagnostics['kinetic'], 1)
+        self.assertAlmostEqual(diagnostics['potential'], -0.06, delta=1e-3)
+        self.assertEqual(diagnostics['momentum'], (2, 0))
+        self.assertAlmostEqual(diagnostics['angular_momentum'], -200)
+        test_engine.tick()
+        self.assertIsNotNone(test_engine.diagnostics)
+
+    def test_enginePerformace(self):
+        test_engine = PMEngine(size=10000)
+        for i in range(100000):
+            test_engine.add_body(
+                cog=(i % 10000, i * 7 % 10000),
+                vel=(0, 0),
+                mass=1
+            )
+        print('Now using PM_Engine')
+        for i in range(10):
+            start = time.time()
+            test_engine.tick()
+            end = time.time() - start
+            print('One tick took %s seconds using %s bodies' % (
+                end, len(test_engine.mass))
+            )
+
+
+@unittest.skipUnless(NumbaBHEngine, 'numba is not installed')
+class NumbaBH_EngineTest(unittest.TestCase):
+
+    def test_sameAsBH(self):
+        for collision_mode in ('elastic', 'inelastic'):
+            local_engine = BHEngine(size=1000, collision_mode=collision_mode)
+            test_engine = NumbaBHEngine(size=1000, collision_mode=collision_mode)
+            for engine in (local_engine, test_engine):
+                for i in range(500):
+                    engine.add_body(
+                        cog=(i * 37 % 400 + 300, i * 53 % 400 + 300),
+                        vel=(i % 3 - 1, i % 5 - 2),
+                        mass=1 + i % 3
+                    )
+            for i in range(3):
+                local_engine.tick()
+                test_engine.tick()
+            local_bodies = local_engine.root_node.bodies
+            numba_bodies = test_engine.root_node.bodies
+            self.assertEqual(len(local_bodies), len(numba_bodies))
+            for body_l, body_n in zip(local_bodies, numba_bodies):
+                self.assertAlmostEqual(body_l.cog[0], body_n.cog[0], delta=1e-6)
+                self.assertAlmostEqual(body_l.cog[1], body_n.cog[1], delta=1e-6)
+
+    def test_precisionSingle(self):
+        engines = [
+            NumbaBHEngine(size=1000, precision='double'),
+            NumbaBHEngine(size=1000, precision='single'),
+        ]
+        for test_engine in engines:
+            for i in range(500):
+                test_engine.add_body(
+                    cog=(i * 37 % 400 + 300, i * 53 % 400 + 300),
+                    vel=(0, 0),
+                    mass=1 + i % 3
+                )
+            test_engine.tick()
+        self.assertEqual(engines[1].cog.dtype.itemsize, 4)
+        double, single = [e.vel for e in engines]
+        self.assertEqual(len(double), len(single))
+        for vel_d, vel_s in zip(double.tolist(), single.tolist()):
+            self.assertAlmostEqual(vel_d[0], vel_s[0], delta=1e-6)
+            self.assertAlmostEqual(vel_d[1], vel_s[1], delta=1e-6)
+
+    def test_diagnostics(self):
+        local_engine = BHEngine(size=1000)
+        test_engine = NumbaBHEngine(size=1000, diagnostics_interval=1)
+        for engine in (local_engine, test_engine):
+            for i in range(500):
+                engine.add_body(
+                    cog=(i * 37 % 400 + 300, i * 53 % 400 + 300),
+                    vel=(i % 3 - 1, i % 5 - 2),
+                    mass=1 + i % 3
+                )
+        local = local_engine.calc_diagnostics()
+        diagnostics = test_engine.calc_diagnostics()
+        for key in ('kinetic', 'potential', 'angular_momentum'):
+            self.assertAlmostEqual(local[key], diagnostics[key], delta=1e-6)
+        self.assertEqual(local['momentum'], diagnostics['momentum'])
+        test_engine.tick()
+        self.assertIsNotNone(test_engine.diagnostics)
 
+    def test_enginePerformace(self):
+        test_engine = NumbaBHEngine(size=10000)
+        for i in range(10000):
+            test_engine.add_body(
+                cog=(i, i),
+                vel=(0, 0),
+                mass=1
+            )
+        print('Now using NumbaBH_Engine')
+        for i in range(10):
+            start = time.time()
+            test_engine.tick()
+            end = time.time() - start
+            print('One tick took %s seconds using %s bodies' % (
+                end, len(test_engine.mass))
+            )
+
+
+@unittest.skipUnless(CyBHEngine, 'cygravity extension is not built')
 class CyBH_EngineTest(unittest.TestCase):
 
     def test_enginePerformace(self):
@@ -87,6 +393,146 @@ class CyBH_EngineTest(unittest.TestCase):
                 end, len(test_engine.root_node.bodies))
             )
 
+    def test_tunePhi(self):
+        phis = []
+        for force_error in (1e-1, 1e-3):
+            test_engine = CyBHEngine(size=1000, force_error=force_error)
+            for i in range(300):
+                test_engine.add_body(
+                    cog=(i * 37 % 1000, i * 53 % 1000),
+                    vel=(0, 0),
+                    mass=1
+                )
+            test_engine.tick()
+            phis.append(test_engine.phi)
+            # error of all bodies at the tuned phi, measured by the python
+            # engine on the same positions
+            check_engine = BHEngine(size=1000)
+            for body in test_engine.root_node.bodies:
+                check_engine.add_body(cog=body.cog, vel=(0, 0), mass=1)
+            check_engine.build_tree()
+            bodies = check_engine.root_node.bodies
+            exact = [check_engine.exact_force(body) for body in bodies]
+            self.assertLessEqual(
+                check_engine.force_error_for(bodies, exact, test_engine.phi),
+                force_error
+            )
+        self.assertTrue(0 < phis[1] < phis[0] <= 2)
+
+    def test_queries(self):
+        test_engine = CyBHEngine(size=1000)
+        for i in range(500):
+            test_engine.add_body(
+                cog=(i * 37 % 1000, i * 53 % 1000),
+                vel=(0, 0),
+                mass=1
+            )
+        test_engine.tick()
+        bodies = test_engine.root_node.bodies
+        point = (420, 380)
+
+        found = test_engine.query_rect(point, 200, 100)
+        expected = [
+            b for b in bodies
+            if 420 <= b.cog[0] < 620 and 380 <= b.cog[1] < 480
+        ]
+        self.assertEqual(set(map(id, found)), set(map(id, expected)))
+
+        found = test_engine.query_radius(point, 150)
+        expected = [b for b in bodies if math.dist(b.cog, point) <= 150]
+        self.assertEqual(set(map(id, found)), set(map(id, expected)))
+
+        found = test_engine.query_nearest(point, 5)
+        expected = sorted(bodies, key=lambda b: math.dist(b.cog, point))[:5]
+        self.assertEqual(
+            [math.dist(b.cog, point) for b in found],
+            [math.dist(b.cog, point) for b in expected]
+        )
+
+        nodes = list(test_engine.iter_nodes())
+        self.assertEqual(
+            list(map(id, nodes)),
+            list(map(id, test_engine.traverse_node(test_engine.root_node)))
+        )
+        self.assertEqual(len(list(test_engine.iter_nodes(max_depth=1))), 5)
+
+    def test_diagnostics(self):
+        test_engine = CyBHEngine(size=1000, diagnostics_interval=1)
+        test_engine.add_body(cog=(100, 100), vel=(1, 0), mass=2)
+        test_engine.add_body(cog=(100, 200), vel=(0, 0), mass=3)
+        diagnostics = test_engine.calc_diagnostics()
+        self.assertAlmostEqual(diagnostics['kinetic'], 1)
+        self.assertAlmostEqual(diagnostics['potential'], -0.06)
+        self.assertAlmostEqual(diagnostics['energy'], 0.94)
+        self.assertEqual(diagnostics['momentum'], (2, 0))
+        self.assertAlmostEqual(diagnostics['angular_momentum'], -200)
+        test_engine.tick()
+        self.assertIsNotNone(test_engine.diagnostics)
+
+
+class BackendsTest(unittest.TestCase):
+
+    calibration = {
+        'bh': {'runs': [
+            {'phi': .5, 'ticks': [(100, .01), (1000, .1)], 'force_error': .01},
+        ]},
+        'numba': {'runs': [
+            {'phi': .25, 'ticks': [(100, .002), (1000, .01)], 'force_error': .002},
+            {'phi': 1.0, 'ticks': [(100, .001), (1000, .005)], 'force_error': .05},
+        ]},
+        'pm': {'runs': [
+            {'phi': None, 'ticks': [(100, .01), (1000, .011)], 'force_error': .01},
+        ]},
+    }
+
+    def test_available(self):
+        names = backends.available()
+        self.assertIn('bh', names)
+        for name in names:
+            test_engine = backends.create(size=1000, backend=name)
+            test_engine.add_body(cog=(100, 100), vel=(0, 0), mass=1)
+            test_engine.add_body(cog=(200, 200), vel=(0, 0), mass=1)
+            test_engine.tick()
+            if name == 'distributed':
+                test_engine.close()
+
+    def test_capabilities(self):
+        self.assertIn('elastic', backends.capabilities('bh')['collision_modes'])
+        self.assertFalse(backends.capabilities('bh')['fixed'])
+        self.assertFalse(backends.capabilities('rk4')['diagnostics'])
+        self.assertTrue(backends.capabilities('cython')['fixed'])
+
+    @mock.patch.object(backends, 'available', lambda: ['bh', 'numba', 'pm'])
+    def test_select(self):
+        select = backends.select
+        calibration = self.calibration
+        self.assertEqual(select(50, calibration=calibration), 'numba')
+        # pm has no collisions, it is only picked on request
+        self.assertEqual(select(100000, calibration=calibration), 'numba')
+        self.assertEqual(
+            select(100000, collision_mode=None, calibration=calibration), 'pm'
+        )
+        self.assertEqual(
+            backends.choose(100000, force_error=.1, calibration=calibration),
+            ('numba', 1.0)
+        )
+        self.assertEqual(
+            backends.choose(100000, force_error=.01, calibration=calibration),
+            ('numba', .25)
+        )
+        self.assertEqual(select(100000, force_error=.001, calibration=calibration), 'bh')
+
+    def test_calibrate(self):
+        table = backends.calibrate(['bh'], sizes=(16, 64), save=False)
+        runs = table['bh']['runs']
+        self.assertEqual([run['phi'] for run in runs], list(backends.PHIS))
+        for run in runs:
+            self.assertEqual([n for n, seconds in run['ticks']], [16, 64])
+        errors = [run['force_error'] for run in runs]
+        self.assertEqual(errors, sorted(errors))
+        self.assertLess(errors[0], .01)
+
+
 
 if __name__ == '__main__':
     unittest.main()